@@ -2,7 +2,23 @@
 # -*- coding: UTF-8 -*-
 __author__ = 'zd'
 
+import os
+import glob
+import math
+import random
+import pickle
+import hashlib
+import collections
+import multiprocessing
+import jieba
 import data_utils
+from utils.corpus import Corpus
+
+# 预处理结果缓存的格式版本，预处理逻辑或格式变化时需要加1
+DATASET_CACHE_VERSION = 2
+
+# 多进程预处理时由fork出的子进程共享（写时复制）的数据，避免为每个任务序列化lexicon
+_prepare_state = None
 
 
 def load_sentences(path):
@@ -14,23 +30,29 @@ def load_sentences(path):
     :return:
     """
     # 存放数据集 [batch_size, sentence_length, 2]
-    sentences = []
+    return list(iter_sentences(path))
+
 
+def iter_sentences(path):
+    """
+    逐句读取数据集，与load_sentences的结果一致但不把整个文件读入内存
+    :param path:
+    :return:
+    """
     # 临时存放一个句子
     sentence = []
 
-    for line in open(path, encoding='UTF-8'):
-        line = line.strip()
-        if not line:
-            sentences.append(sentence)
-            sentence = []
-        else:
-            sentence.append(line.split())
+    with open(path, encoding='UTF-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                yield sentence
+                sentence = []
+            else:
+                sentence.append(line.split())
 
     if sentence:
-        sentences.append(sentence)
-
-    return sentences
+        yield sentence
 
 
 def update_tag_scheme(sentences, tag_scheme):
@@ -41,20 +63,31 @@ def update_tag_scheme(sentences, tag_scheme):
     :return:
     """
     for i, s in enumerate(sentences):
-        tags = [w[-1] for w in s]
-        if not data_utils.check_bio(tags):
-            raise Exception('输入的句子应为BIO标注法，请检查%i句' % i)
-
-        if tag_scheme == 'BIO':
-            for word, new_tag in zip(s, tags):
-                word[-1] = new_tag
-
-        if tag_scheme == 'BIOES':
-            new_tags = data_utils.bio_to_bioes(tags)
-            for word, new_tag in zip(s, new_tags):
-                word[-1] = new_tag
-        else:
-            raise Exception('非法编码')
+        convert_tag_scheme(s, tag_scheme, i)
+
+
+def convert_tag_scheme(s, tag_scheme, i=0):
+    """
+    把一个BIO标注的句子原地转换为指定标签
+    :param s:
+    :param tag_scheme:
+    :param i: 句子的序号，用于报错
+    :return:
+    """
+    tags = [w[-1] for w in s]
+    if not data_utils.check_bio(tags):
+        raise Exception('输入的句子应为BIO标注法，请检查%i句' % i)
+
+    if tag_scheme == 'BIO':
+        for word, new_tag in zip(s, tags):
+            word[-1] = new_tag
+
+    if tag_scheme == 'BIOES':
+        new_tags = data_utils.bio_to_bioes(tags)
+        for word, new_tag in zip(s, new_tags):
+            word[-1] = new_tag
+    else:
+        raise Exception('非法编码')
 
 
 def word_mapping(sentences):
@@ -83,31 +116,384 @@ def tag_mapping(sentences):
     return dico, tag_to_id, id_to_tag
 
 
-def prepare_dataset(sentences, word_to_id, tag_to_id, lexicon, train=True):
+def split_corpus(paths, chunk_bytes=1 << 24):
+    """
+    按句子边界把文件切成约chunk_bytes大小的块
+    :param paths:
+    :param chunk_bytes:
+    :return: [(path, start, end), ...]，每块从句首开始、在空行之后结束
+    """
+    chunks = []
+    for path in paths:
+        size = os.path.getsize(path)
+        start = 0
+        with open(path, 'rb') as f:
+            while start < size:
+                pos = start + chunk_bytes
+                if pos >= size:
+                    end = size
+                else:
+                    # 从pos的前一个字节读到行尾，丢掉不完整的行，之后都是整行，pos恰好在行首时只丢掉前一行的换行符
+                    f.seek(pos - 1)
+                    f.readline()
+                    line = f.readline()
+                    while line and line.strip():
+                        line = f.readline()
+                    end = f.tell()
+                chunks.append((path, start, end))
+                start = end
+    return chunks
+
+
+def _count_chunk(args):
+    """
+    统计一块语料的字和转换后标签的个数
+    :param args: path, start, end, tag_scheme，tag_scheme为None时不统计标签
+    :return: 字的Counter，标签的Counter
+    """
+    path, start, end, tag_scheme = args
+    words = collections.Counter()
+    tags = collections.Counter()
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+        at_eof = not f.read(1)
+    lines = data.decode('UTF-8').splitlines()
+    # 除了文件的最后一块，每块都应在空行之后结束，否则句子会被切断
+    if not at_eof and not (data.endswith(b'\n') and lines and not lines[-1].strip()):
+        raise Exception('%s第%i到%i字节的块没有在空行处结束' % (path, start, end))
+    sentence = []
+    for line in lines + ['']:
+        line = line.strip()
+        if line:
+            sentence.append(line.split())
+            continue
+        if not sentence:
+            continue
+        words.update(w[0] for w in sentence)
+        if tag_scheme is not None:
+            try:
+                convert_tag_scheme(sentence, tag_scheme)
+            except Exception as e:
+                raise Exception('%s第%i字节之后：%s' % (path, start, e))
+            tags.update(w[-1] for w in sentence)
+        sentence = []
+    return words, tags
+
+
+def count_corpus(paths, tag_scheme=None, num_workers=1, chunk_bytes=1 << 24):
+    """
+    单遍统计字和标签的个数，按块分给多个进程后合并计数
+    :param paths: 语料文件列表
+    :param tag_scheme: 标签转换为的编码，None时不统计标签
+    :param num_workers:
+    :param chunk_bytes: 每块的字节数，单个进程的内存占用与它成正比
+    :return: 字的Counter，标签的Counter
+    """
+    tasks = [chunk + (tag_scheme,) for chunk in split_corpus(paths, chunk_bytes)]
+    words = collections.Counter()
+    tags = collections.Counter()
+    if num_workers <= 1 or len(tasks) <= 1:
+        results = map(_count_chunk, tasks)
+        for chunk_words, chunk_tags in results:
+            words.update(chunk_words)
+            tags.update(chunk_tags)
+        return words, tags
+    pool = multiprocessing.Pool(min(num_workers, len(tasks)))
+    try:
+        for chunk_words, chunk_tags in pool.imap_unordered(_count_chunk, tasks):
+            words.update(chunk_words)
+            tags.update(chunk_tags)
+    finally:
+        pool.terminate()
+    return words, tags
+
+
+def build_maps(train_files, tag_scheme, map_file, test_files=None, emb_file=None, word_dim=None,
+               num_workers=1, chunk_bytes=1 << 24):
+    """
+    统计训练集得到字和标签的映射并写入map_file，与word_mapping、tag_mapping、augment_with_pretrained的结果一致
+    :param train_files:
+    :param tag_scheme:
+    :param map_file:
+    :param test_files: emb_file不为空时，测试集中在预训练向量里出现的字也加入映射
+    :param emb_file: 预训练字向量，None时不扩充
+    :param word_dim:
+    :param num_workers:
+    :param chunk_bytes:
+    :return: word_to_id, id_to_word, tag_to_id, id_to_tag
+    """
+    word_counts, tag_counts = count_corpus(train_files, tag_scheme, num_workers, chunk_bytes)
+    dico = dict(word_counts)
+    dico['<PAD>'] = 1000001
+    dico['<UNK>'] = 1000000
+    if emb_file:
+        test_words = count_corpus(test_files or [], None, num_workers, chunk_bytes)[0]
+        _, word_to_id, id_to_word = data_utils.augment_with_pretrained(dico, emb_file, list(test_words), word_dim)
+    else:
+        word_to_id, id_to_word = data_utils.create_mapping(dico)
+    tag_to_id, id_to_tag = data_utils.create_mapping(dict(tag_counts))
+    with open(map_file, 'wb') as f:
+        pickle.dump([word_to_id, id_to_word, tag_to_id, id_to_tag], f, pickle.HIGHEST_PROTOCOL)
+    return word_to_id, id_to_word, tag_to_id, id_to_tag
+
+
+def prepare_dataset(sentences, word_to_id, tag_to_id, lexicon, train=True, seg_cache=None,
+                    num_workers=1, chunk_size=1000, seg_backend='jieba', seed=0):
     """
-    数据预处理，返回的list包含：word_list word_id_list word_seg_list, tag_is_list
+    数据预处理，按chunk_size个句子一块处理后拼接成Corpus
     :param sentences:
     :param word_to_id:
     :param tag_to_id:
     :param lexicon: lexicon对象
     :param train:
-    :return:
+    :param seg_cache: 分词缓存
+    :param num_workers: 进程数，大于1时按chunk_size个句子一块分给fork出的子进程，结果保持原顺序
+    :param chunk_size:
+    :param seg_backend: 分词特征的来源，jieba为结巴分词，lexicon为在lexicon匹配结果上做正向最大匹配
+    :param seed: lexicon特征补齐时的随机种子
+    :return: Corpus，每句包含words word_ids segs tag_ids lexicon_ids
     """
-    none_index = tag_to_id['O']
-    data = []
-    for s in sentences:
-        word_list = [w[0] for w in s]
-        word_id_list = [word_to_id[w if w in word_to_id else '<UNK>'] for w in word_list]
-        seg_list = data_utils.get_seg_feature("".join(word_list))
-        lexicon_list = data_utils.get_lexicon_feature(''.join(word_list), lexicon)
-        if train:
-            tag_id_list = [tag_to_id[w[-1]] for w in s]
-        else:
-            tag_id_list = [none_index for w in s]
-        data.append([word_list, word_id_list, seg_list, tag_id_list, lexicon_list])
+    chunks = [(i, min(i + chunk_size, len(sentences))) for i in range(0, len(sentences), chunk_size)]
+    if num_workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return Corpus.concatenate(
+            Corpus.from_rows([_prepare_sentence(s, word_to_id, tag_to_id, lexicon, train, seg_cache, seg_backend, seed)
+                              for s in sentences[start:end]])
+            for start, end in chunks
+        )
+
+    global _prepare_state
+    if seg_cache is not None:
+        seg_cache.flush()
+    # 在fork之前加载结巴词典，子进程直接共享
+    if seg_backend == 'jieba':
+        jieba.initialize()
+    _prepare_state = (sentences, word_to_id, tag_to_id, lexicon, train, seg_cache, seg_backend, seed)
+    try:
+        pool = multiprocessing.get_context('fork').Pool(num_workers)
+        try:
+            parts = []
+            for part, stats in pool.imap(_prepare_chunk, chunks):
+                parts.append(part)
+                if seg_cache is not None:
+                    seg_cache.hits += stats[0]
+                    seg_cache.misses += stats[1]
+                    seg_cache.miss_time += stats[2]
+        finally:
+            pool.terminate()
+    finally:
+        _prepare_state = None
+    return Corpus.concatenate(parts)
+
+
+def _prepare_sentence(s, word_to_id, tag_to_id, lexicon, train, seg_cache, seg_backend, seed):
+    word_list = [w[0] for w in s]
+    word_id_list = [word_to_id[w if w in word_to_id else '<UNK>'] for w in word_list]
+    sentence = ''.join(word_list)
+    matches = lexicon.match_sentence(sentence)
+    if seg_backend == 'lexicon':
+        seg_list = data_utils.get_lexicon_seg_feature(len(sentence), matches)
+    else:
+        seg_list = data_utils.get_seg_feature(sentence, seg_cache)
+    lexicon_list = data_utils.get_lexicon_feature(sentence, lexicon, matches, seed)
+    if train:
+        tag_id_list = [tag_to_id[w[-1]] for w in s]
+    else:
+        tag_id_list = [tag_to_id['O']] * len(s)
+    return [word_list, word_id_list, seg_list, tag_id_list, lexicon_list]
+
+
+def _prepare_chunk(chunk):
+    """
+    子进程中处理[start, end)的句子
+    :param chunk:
+    :return: 处理结果的Corpus，分词缓存的(hits, misses, miss_time)增量
+    """
+    sentences, word_to_id, tag_to_id, lexicon, train, seg_cache, seg_backend, seed = _prepare_state
+    start, end = chunk
+    if seg_cache is not None:
+        before = (seg_cache.hits, seg_cache.misses, seg_cache.miss_time)
+    part = Corpus.from_rows([_prepare_sentence(s, word_to_id, tag_to_id, lexicon, train, seg_cache, seg_backend, seed)
+                             for s in sentences[start:end]])
+    if seg_cache is None:
+        return part, None
+    seg_cache.flush()
+    return part, (seg_cache.hits - before[0], seg_cache.misses - before[1], seg_cache.miss_time - before[2])
+
+
+def load_dataset(path, tag_scheme, word_to_id, tag_to_id, lexicon, map_file, cache_dir=None, train=True,
+                 seg_cache=None, num_workers=1, chunk_size=1000, seg_backend='jieba', seed=0):
+    """
+    load_sentences -> update_tag_scheme -> prepare_dataset
+    cache_dir不为空时把Corpus缓存为npz，key包括语料、maps.pkl、lexicon的版本、标注方式和特征的参数
+    :param path:
+    :param tag_scheme:
+    :param word_to_id:
+    :param tag_to_id:
+    :param lexicon:
+    :param map_file: word_to_id和tag_to_id所在的文件
+    :param cache_dir:
+    :return: 与prepare_dataset一致
+    """
+    cache_file = None
+    if cache_dir:
+        key = dataset_cache_key(path, map_file, lexicon, tag_scheme, train, seg_backend, seed)
+        cache_file = os.path.join(cache_dir, '%s.%s.npz' % (os.path.basename(path), key))
+        if os.path.isfile(cache_file):
+            return Corpus.load(cache_file)
+
+    sentences = load_sentences(path)
+    update_tag_scheme(sentences, tag_scheme)
+    data = prepare_dataset(sentences, word_to_id, tag_to_id, lexicon, train, seg_cache,
+                           num_workers, chunk_size, seg_backend, seed)
+    if cache_file:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        data.save(cache_file)
     return data
 
 
+def dataset_cache_key(path, map_file, lexicon, tag_scheme, train, seg_backend, seed):
+    assert lexicon.version, 'the lexicon has no version, it can not be used in a dataset cache key'
+    parts = [DATASET_CACHE_VERSION, data_utils.file_hash(path), data_utils.file_hash(map_file), lexicon.version,
+             tag_scheme, train, seg_backend, seed]
+    if seg_backend == 'jieba':
+        parts.append(data_utils.jieba_version())
+    return hashlib.sha1('\n'.join(str(part) for part in parts).encode('UTF-8')).hexdigest()[:16]
+
+
+def expand_shards(paths):
+    """
+    :param paths: 逗号分隔的文件名，可以包含通配符
+    :return: 按文件名排序的分片列表
+    """
+    shards = []
+    for pattern in paths.split(','):
+        pattern = pattern.strip()
+        if pattern:
+            matched = sorted(glob.glob(pattern))
+            if not matched:
+                raise Exception('找不到数据文件%s' % pattern)
+            shards.extend(matched)
+    return shards
+
+
+class StreamingBatchManager(object):
+    """
+    流式读取一个或多个分片，逐句转换标签和计算特征
+    在buffer_size个句子的缓冲区内按长度排序分batch，内存占用与语料大小无关
+    """
+    def __init__(self, shards, tag_scheme, word_to_id, tag_to_id, lexicon, batch_size, buffer_size=10000,
+                 train=True, seg_cache=None, seg_backend='jieba', seed=0, max_tokens=None, pack_length=None):
+        """
+        :param shards: 分片文件列表
+        :param buffer_size: 缓冲区的句子数，越大batch内长度越接近、打乱越充分
+        :param max_tokens: 按补齐后的token数分batch，None时每个batch为batch_size个句子
+        :param pack_length: 不为空时把短句拼接成不超过pack_length的行，batch_size为每个batch的行数
+        :return:
+        """
+        assert buffer_size >= batch_size, 'buffer_size must be at least batch_size'
+        self.shards = list(shards)
+        self.tag_scheme = tag_scheme
+        self.word_to_id = word_to_id
+        self.tag_to_id = tag_to_id
+        self.lexicon = lexicon
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.train = train
+        self.seg_cache = seg_cache
+        self.seg_backend = seg_backend
+        self.seed = seed
+        self.max_tokens = max_tokens
+        self.pack_length = pack_length
+        self.num_sentences = 0
+        self.num_tokens = 0
+        for shard in self.shards:
+            for s in iter_sentences(shard):
+                if s:
+                    self.num_sentences += 1
+                    self.num_tokens += len(s)
+        if max_tokens or pack_length:
+            # 按token数分batch或打包时batch数与缓冲区内的长度分布有关，先估计，跑完一轮后更新
+            tokens_per_batch = max_tokens or pack_length * batch_size
+            self._len_data = int(math.ceil(self.num_tokens / tokens_per_batch))
+        else:
+            # 缓冲区最后一个batch会并入下一个缓冲区，所以batch数只由句子数决定
+            self._len_data = int(math.ceil(self.num_sentences / batch_size))
+
+    def iter_rows(self, shuffle=False):
+        shards = list(self.shards)
+        if shuffle:
+            random.shuffle(shards)
+        for shard in shards:
+            for i, s in enumerate(iter_sentences(shard)):
+                if not s:
+                    continue
+                convert_tag_scheme(s, self.tag_scheme, i)
+                yield _prepare_sentence(s, self.word_to_id, self.tag_to_id, self.lexicon, self.train,
+                                        self.seg_cache, self.seg_backend, self.seed)
+
+    def _split_buffer(self, buffer, shuffle, last=False):
+        """
+        缓冲区按长度排序后切成batch，除了最后一次，最后一个batch的句子留在缓冲区
+        :param buffer:
+        :param shuffle:
+        :param last: 是否已经读完所有分片
+        :return: batch列表，每个batch为(句子, 每行句子的范围)，剩下的句子
+        """
+        if shuffle:
+            # 长度相同的句子之间也要打乱
+            random.shuffle(buffer)
+        buffer.sort(key=lambda x: len(x[0]))
+        lengths = [len(row[0]) for row in buffer]
+        if self.pack_length:
+            spans = [(rows[0][0], rows[-1][1], rows) for rows in
+                     data_utils.pack_batches(lengths, self.batch_size, self.pack_length, self.max_tokens)]
+        else:
+            spans = [(start, end, None) for start, end in
+                     data_utils.bucket_batches(lengths, self.batch_size, self.max_tokens)]
+        rest = []
+        if not last and spans:
+            rest = buffer[spans[-1][0]:]
+            spans = spans[:-1]
+        batches = []
+        for start, end, rows in spans:
+            if rows is not None:
+                rows = [range(row_start - start, row_end - start) for row_start, row_end in rows]
+            batches.append((buffer[start:end], rows))
+        if shuffle:
+            random.shuffle(batches)
+        return batches, rest
+
+    @staticmethod
+    def _to_batch(sentences, rows):
+        corpus = Corpus.from_rows(sentences)
+        if rows is None:
+            return corpus.pad(range(len(sentences)))
+        return corpus.pack(rows)
+
+    def iter_batch(self, shuffle=False):
+        buffer = []
+        limit = self.buffer_size
+        num_batch = 0
+        for row in self.iter_rows(shuffle):
+            buffer.append(row)
+            if len(buffer) >= limit:
+                batches, buffer = self._split_buffer(buffer, shuffle)
+                # 留下的句子不计入下一个缓冲区的大小，避免每读一句都重新切分
+                limit = len(buffer) + self.buffer_size
+                for sentences, rows in batches:
+                    num_batch += 1
+                    yield self._to_batch(sentences, rows)
+        batches, _ = self._split_buffer(buffer, shuffle, last=True)
+        for sentences, rows in batches:
+            num_batch += 1
+            yield self._to_batch(sentences, rows)
+        self._len_data = num_batch
+        if self.seg_cache is not None:
+            self.seg_cache.flush()
+
+
 if __name__ == '__main__':
     sentences = load_sentences('./data/ner.dev')
     update_tag_scheme(sentences, 'BIOES')
@@ -3,12 +3,23 @@
 # __author__ = 'zd'
 
 import jieba
-import math
 import random
 import os
+import json
+import shutil
+import hashlib
+import collections
+import multiprocessing
 import numpy as np
 import random
 from utils.lexicon import Lexicon
+from utils.corpus import Corpus
+
+# hashed lexicon embedding中把词id映射到桶的乘数（Knuth乘法hash）
+LEXICON_HASH_MULTIPLIER = 2654435761
+
+# lexicon bundle的格式版本，格式变化时需要加1，旧的bundle会被重新构建
+LEXICON_BUNDLE_VERSION = 2
 
 
 def check_bio(tags):
@@ -90,15 +101,10 @@ def create_dico(item_list):
     :param item_list:
     :return:
     """
-    assert type(item_list) == list
-    dico = {}
+    dico = collections.Counter()
     for items in item_list:
-        for item in items:
-            if item not in dico:
-                dico[item] = 1
-            else:
-                dico[item] += 1
-    return dico
+        dico.update(items)
+    return dict(dico)
 
 
 def create_mapping(dico):
@@ -113,13 +119,17 @@ def create_mapping(dico):
     return item_to_id, id_to_item
 
 
-def get_seg_feature(words):
+def get_seg_feature(words, seg_cache=None):
     """
     利用结巴分词
     类是BIOES标注法，0表示单字成词，1表示一个词的开始，2表示一个词的中间，3表示一个词的结束
     :param words:
+    :param seg_cache: utils.seg_cache.SegCache，为None时不使用缓存
     :return:
     """
+    if seg_cache is not None:
+        return seg_cache.get(words, get_seg_feature)
+
     seg_features = []
 
     word_list = list(jieba.cut(words))
@@ -135,51 +145,170 @@ def get_seg_feature(words):
     return seg_features
 
 
-def load_word2vec(emb_file, id_to_word, word_dim, old_weights):
+def get_lexicon_seg_feature(sentence_length, matches):
+    """
+    用lexicon的匹配结果做正向最大匹配分词，标签与get_seg_feature一致
+    :param sentence_length:
+    :param matches: Lexicon.match_sentence的结果，按start升序、同一start内按长度降序
+    :return:
+    """
+    longest = {}
+    for start, end, _ in matches:
+        if start not in longest:
+            longest[start] = end
+    seg_features = []
+    i = 0
+    while i < sentence_length:
+        end = longest.get(i, i + 1)
+        if end - i == 1:
+            seg_features.append(0)
+        else:
+            seg_features.append(1)
+            seg_features.extend([2] * (end - i - 2))
+            seg_features.append(3)
+        i = end
+    return seg_features
+
+
+def jieba_version():
+    """
+    结巴分词器的版本，包括词典文件，作为分词缓存key的一部分
+    :return:
+    """
+    dictionary = jieba.dt.dictionary
+    if dictionary and os.path.isfile(dictionary):
+        stat = os.stat(dictionary)
+        dictionary = '%s %i %s' % (os.path.abspath(dictionary), stat.st_size, stat.st_mtime)
+    return 'jieba %s %s' % (jieba.__version__, dictionary or jieba.DEFAULT_DICT_NAME)
+
+
+class EmbeddingIndex(object):
+    """
+    预训练字向量文件的索引，只扫描一遍文件，只保留需要的词的向量
+    同一个文件的索引在进程内共享，augment_with_pretrained扫描过的词load_word2vec不再重新读取
+    """
+    _indexes = {}
+
+    def __init__(self, emb_path, word_dim):
+        self.emb_path = emb_path
+        self.word_dim = word_dim
+        self.requested = None       # None表示保留文件中的所有词
+        self.tokens = set()         # 文件中出现过的（需要的）词
+        self.vectors = {}           # 维度正确的词向量
+        self.invalid = 0
+
+    @classmethod
+    def get(cls, emb_path, word_dim, tokens=None):
+        """
+        返回包含tokens的索引，已有的索引不包含全部tokens时重新扫描
+        :param emb_path:
+        :param word_dim:
+        :param tokens: 需要的词，None表示全部
+        :return:
+        """
+        key = (os.path.abspath(emb_path), word_dim)
+        index = cls._indexes.get(key)
+        if index is None or not index.covers(tokens):
+            index = cls(emb_path, word_dim)
+            index.scan(tokens)
+            cls._indexes[key] = index
+        return index
+
+    def covers(self, tokens):
+        if self.requested is None:
+            return True
+        return tokens is not None and self.requested.issuperset(tokens)
+
+    def scan(self, tokens=None):
+        self.requested = None if tokens is None else set(tokens)
+        for line in open(self.emb_path, encoding='UTF-8'):
+            line = line.rstrip().split()
+            if not line:
+                continue
+            if self.requested is not None and line[0] not in self.requested:
+                continue
+            self.tokens.add(line[0])
+            if len(line) == self.word_dim + 1:
+                self.vectors[line[0]] = np.array([float(x) for x in line[1:]]).astype(np.float32)
+            else:
+                self.invalid += 1
+
+    def __contains__(self, token):
+        return token in self.tokens
+
+
+def word2vec_cache_path(map_file):
+    """
+    字向量矩阵的缓存文件，与maps.pkl放在一起
+    :param map_file:
+    :return:
+    """
+    return os.path.splitext(map_file)[0] + '.emb.npz'
+
+
+def _word2vec_cache_key(emb_file, id_to_word, word_dim):
+    stat = os.stat(emb_file)
+    sha1 = hashlib.sha1()
+    sha1.update(('%s %i %s %i\n' % (os.path.abspath(emb_file), stat.st_size, stat.st_mtime, word_dim)).encode('UTF-8'))
+    for i in range(len(id_to_word)):
+        sha1.update((id_to_word[i] + '\n').encode('UTF-8'))
+    return sha1.hexdigest()
+
+
+def load_word2vec(emb_file, id_to_word, word_dim, old_weights, cache_file=None):
     """
     :param emb_file:
     :param id_to_word:
     :param word_dim:
     :param old_weight:
+    :param cache_file: [num_words, word_dim]矩阵的缓存，字表和向量文件不变时直接读取
     :return:
     """
+    key = _word2vec_cache_key(emb_file, id_to_word, word_dim)
+    if cache_file and os.path.isfile(cache_file):
+        with np.load(cache_file) as cache:
+            if str(cache['key']) == key:
+                print('从缓存%s加载词向量' % cache_file)
+                return cache['weights']
+
     new_weights = old_weights
-    pre_trained = {}
-    emb_invalid = 0
-    for i, line in enumerate(open(emb_file, encoding='UTF-8')):
-        line = line.rstrip().split()
-        if len(line) == word_dim + 1:
-            pre_trained[line[0]] = np.array([float(x) for x in line[1:]]).astype(np.float32)
-        else:
-            emb_invalid += 1
-    if emb_invalid > 0:
-        print('waring: %i initializer lines' % emb_invalid)
+    index = EmbeddingIndex.get(emb_file, word_dim, id_to_word.values())
+    if index.invalid > 0:
+        print('waring: %i initializer lines' % index.invalid)
     num_words = len(id_to_word)
     for i in range(num_words):
         word = id_to_word[i]
-        if word in pre_trained:
-            new_weights[i] = pre_trained[word]
-    print('加载了 %i 个词向量' % len(pre_trained))
+        if word in index.vectors:
+            new_weights[i] = index.vectors[word]
+    print('加载了 %i 个词向量' % len(index.vectors))
 
+    if cache_file:
+        np.savez(cache_file, weights=new_weights, key=key)
     return new_weights
 
 
-def augment_with_pretrained(dico_train, emb_path, test_word):
+def augment_with_pretrained(dico_train, emb_path, test_word, word_dim):
     """
     :param dico_train:
     :param emb_path:
     :param test_word:
+    :param word_dim:
     :return:
     """
     assert os.path.isfile(emb_path)
 
-    # 加载词向量
-    pretrained = set([line.rsplit()[0].strip() for line in open(emb_path, encoding='UTF-8')])
+    # 加载词向量，只保留训练集和测试集中出现的词
     if test_word is None:
-        for word in pretrained:
+        pretrained = EmbeddingIndex.get(emb_path, word_dim)
+        for word in pretrained.tokens:
             if word not in dico_train:
                 dico_train[word] = 0
     else:
+        tokens = set(dico_train)
+        for word in test_word:
+            tokens.add(word)
+            tokens.add(word.lower())
+        pretrained = EmbeddingIndex.get(emb_path, word_dim, tokens)
         for word in test_word:
             if any(x in pretrained for x in [word, word.lower()]) and word not in dico_train:
                 dico_train[word] = 0
@@ -188,36 +317,103 @@ def augment_with_pretrained(dico_train, emb_path, test_word):
     return dico_train, word_to_id, id_to_word
 
 
+def bucket_batches(lengths, batch_size, max_tokens=None):
+    """
+    把按长度升序排列的句子切成batch，最后不满的batch也保留
+    :param lengths: 升序排列的句子长度
+    :param batch_size: 每个batch的句子数，max_tokens不为空时不使用
+    :param max_tokens: 每个batch补齐后的token数上限，超过上限的单个句子单独成一个batch
+    :return: [(start, end), ...]
+    """
+    num = len(lengths)
+    if not max_tokens:
+        return [(i, min(i + batch_size, num)) for i in range(0, num, batch_size)]
+    batches = []
+    start = 0
+    for i, length in enumerate(lengths):
+        # 长度升序，加入第i句后batch补齐的长度就是length
+        if i > start and (i - start + 1) * length > max_tokens:
+            batches.append((start, i))
+            start = i
+    if start < num:
+        batches.append((start, num))
+    return batches
+
+
+def pack_batches(lengths, batch_size, pack_length, max_tokens=None):
+    """
+    把按长度升序排列的句子依次放进长度不超过pack_length的行，再把行切成batch，最后不满的batch也保留
+    :param lengths: 升序排列的句子长度
+    :param batch_size: 每个batch的行数，max_tokens不为空时不使用
+    :param pack_length: 每行的token数上限，超过上限的单个句子单独成一行
+    :param max_tokens: 每个batch补齐后的token数上限
+    :return: [[(start, end), ...], ...]，每个batch中每行包含的句子范围
+    """
+    rows = []
+    start = 0
+    used = 0
+    for i, length in enumerate(lengths):
+        if i > start and used + length > pack_length:
+            rows.append((start, i, used))
+            start = i
+            used = 0
+        used += length
+    if start < len(lengths):
+        rows.append((start, len(lengths), used))
+
+    batches = []
+    batch = []
+    row_length = 0
+    for start, end, used in rows:
+        if batch and (len(batch) >= batch_size if not max_tokens
+                      else (len(batch) + 1) * max(row_length, used) > max_tokens):
+            batches.append(batch)
+            batch = []
+            row_length = 0
+        batch.append((start, end))
+        row_length = max(row_length, used)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
 class BatchManager(object):
-    def __init__(self, data, batch_size):
-        self._batch_data = self._sort_and_pad(data, batch_size)
+    def __init__(self, data, batch_size, max_tokens=None, pack_length=None):
+        """
+        构造时一次性把每个batch补齐成连续的int32数组，训练时直接送入feed_dict
+        :param data: prepare_dataset返回的Corpus，也可以是按句子的list
+        :param batch_size:
+        :param max_tokens: 按补齐后的token数分batch，None时每个batch为batch_size个句子
+        :param pack_length: 不为空时把短句拼接成不超过pack_length的行，batch_size为每个batch的行数
+        """
+        if not isinstance(data, Corpus):
+            data = Corpus.from_rows(data)
+        self._batch_data = self._sort_and_pad(data, batch_size, max_tokens, pack_length)
         self._len_data = len(self._batch_data)
 
     @staticmethod
     def pad_data(data):
-        word_list = []
-        word_id_list = []
-        seg_list = []
-        tag_id_list = []
-        lexicon_list = []
-        max_length = max([len(s[0]) for s in data])
-        for line in data:
-            words, word_ids, segs, tag_ids, lexicon_ = line
-            padding = [0] * (max_length - len(words))
-            word_list.append(words + padding)
-            word_id_list.append(word_ids + padding)
-            seg_list.append(segs + padding)
-            tag_id_list.append(tag_ids + padding)
-            lexicon_list.append(lexicon_ + padding)
-        return [word_list, word_id_list, seg_list, tag_id_list, lexicon_list]
-
-    def _sort_and_pad(self, data, batch_size):
-        num_batch = int(math.floor(len(data) / batch_size))
-        sorted_data = sorted(data, key=lambda x: len(x[0]))
-        batch_data = list()
-        for i in range(num_batch):
-            batch_data.append(self.pad_data(sorted_data[i * batch_size:(i + 1) * batch_size]))
-        return batch_data
+        return Corpus.from_rows(data).pad(np.arange(len(data)))
+
+    def _sort_and_pad(self, data, batch_size, max_tokens=None, pack_length=None):
+        """
+        按长度排序后切分补齐，所有句子都会出现在某个batch中
+        :param data:
+        :param batch_size:
+        :param max_tokens:
+        :param pack_length:
+        :return: [strings, word_ids, segs, tag_ids, lexicon_ids]的列表，strings只在评估时使用，打包时另有pack_index
+        """
+        sorted_index = np.argsort(data.lengths(), kind='mergesort')
+        sorted_lengths = data.lengths()[sorted_index]
+        if pack_length:
+            return [data.pack([sorted_index[start:end] for start, end in rows])
+                    for rows in pack_batches(sorted_lengths, batch_size, pack_length, max_tokens)]
+        batches = bucket_batches(sorted_lengths, batch_size, max_tokens)
+        return [data.pad(sorted_index[start:end]) for start, end in batches]
+
+    def nbytes(self):
+        return sum(array.nbytes for batch in self._batch_data for array in batch)
 
     def iter_batch(self, shuffle=False):
         if shuffle:
@@ -226,55 +422,454 @@ class BatchManager(object):
             yield self._batch_data[i]
 
 
-def get_lexicon_feature(sentence, lexicon):
+def get_lexicon_feature(sentence, lexicon, matches=None, seed=0):
     """
-    返回lexicon字典
+    返回lexicon字典，匹配到的词不足句子长度时随机取句子中的字补齐
+    随机数由seed和句子本身决定，同样的输入总是得到同样的特征
     :param sentence:
     :param lexicon: 词表
+    :param matches: 已经计算好的lexicon.match_sentence(sentence)
+    :param seed:
     :return:
     """
-    features = []
     sentence_length = len(sentence)
-    for i in range(sentence_length):
-        match_entity = lexicon.enumerate_match_list(sentence[i:])
-        if len(match_entity) != 0:
-            features.extend(match_entity)
+    if matches is None:
+        matches = lexicon.match_sentence(sentence)
+    features = [lexicon_id for _, _, lexicon_id in matches]
     if len(features) < sentence_length:
         n_dif = sentence_length - len(features)
-        features.extend(random.sample(sentence, n_dif))
+        rng = random.Random('%s\n%s' % (seed, sentence))
+        features.extend(lexicon.search_id(w) for w in rng.sample(sentence, n_dif))
     else:
         features = features[:sentence_length]
-    features = [lexicon.search_id(w) for w in features]
     return features
 
 
-def get_lexicon(lexicon_path):
+def get_lexicon(lexicon_path, compact=True, bundle_path=None, num_workers=None):
     """
     获得词典
     :param lexicon_path:
+    :param compact: 是否使用紧凑的数组trie
+    :param bundle_path: 预编译的lexicon bundle文件夹，不存在或已过期时先构建，只在compact模式下使用
+    :param num_workers: 解析embedding的进程数，None为cpu核数
+    :return: lexicon, num_lexicon, lexicon_dim, embeddings [num_lexicon + 1, lexicon_dim]的np.float32矩阵
+    """
+    if bundle_path and compact:
+        if not lexicon_bundle_is_fresh(lexicon_path, bundle_path):
+            build_lexicon_bundle(lexicon_path, bundle_path, num_workers)
+        return load_lexicon_bundle(bundle_path)
+    return read_lexicon(lexicon_path, compact, num_workers=num_workers)
+
+
+def _parse_lexicon_lines(lines, lexicon_dim):
+    """
+    在子进程中解析一块lexicon文本
+    :param lines:
+    :param lexicon_dim:
+    :return: words, [len(words), lexicon_dim]的np.float32矩阵，维度不对的行被丢弃
+    """
+    words = []
+    vectors = np.empty([len(lines), lexicon_dim], dtype=np.float32)
+    for line in lines:
+        line = line.strip().split(None, 1)
+        if len(line) != 2:
+            continue
+        vector = np.fromstring(line[1], dtype=np.float32, sep=' ')
+        if vector.shape[0] != lexicon_dim:
+            continue
+        vectors[len(words)] = vector
+        words.append(line[0])
+    return words, vectors[:len(words)]
+
+
+def _lexicon_chunks(f, lexicon_dim, chunk_bytes):
+    """
+    按大小切块读取lexicon文本，每行按文本长度加上解析后向量的字节数计算
+    :param f:
+    :param lexicon_dim:
+    :param chunk_bytes: 每块的字节数上限，至少包含一行
+    :return:
+    """
+    lines = []
+    size = 0
+    for line in f:
+        lines.append(line)
+        size += len(line) + 4 * lexicon_dim
+        if size >= chunk_bytes:
+            yield lines
+            lines = []
+            size = 0
+    if lines:
+        yield lines
+
+
+def _iter_lexicon_chunks(f, lexicon_dim, num_workers, buffer_bytes):
+    """
+    按块读取文件并用进程池解析，按文件顺序返回结果
+    同时在途的块不超过2 * num_workers，每块为buffer_bytes / (2 * num_workers)，
+    所以在途的文本和解析结果合计约为buffer_bytes，与进程数无关
+    :param f:
+    :param lexicon_dim:
+    :param num_workers:
+    :param buffer_bytes:
     :return:
     """
-    lexicon = Lexicon()
-    embeddings = []
+    if num_workers == 1:
+        for lines in _lexicon_chunks(f, lexicon_dim, buffer_bytes):
+            yield _parse_lexicon_lines(lines, lexicon_dim)
+        return
+    chunks = _lexicon_chunks(f, lexicon_dim, buffer_bytes // (2 * num_workers))
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        pending = collections.deque()
+        for lines in chunks:
+            pending.append(pool.apply_async(_parse_lexicon_lines, (lines, lexicon_dim)))
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def read_lexicon(lexicon_path, compact=True, allocate=np.zeros, num_workers=None, buffer_bytes=1 << 28):
+    """
+    流式解析文本格式的lexicon，embedding直接写入按首行大小预先分配的float32矩阵
+    词的id与矩阵的行一一对应，重复的词只保留第一次出现的向量
+    除了矩阵和trie，读取时的缓冲约为buffer_bytes（在途的文本和解析出的向量），不随进程数增长
+    :param lexicon_path:
+    :param compact:
+    :param allocate: 分配矩阵的函数 allocate(shape, dtype)，默认在内存中分配
+    :param num_workers: 解析进程数，None为cpu核数
+    :param buffer_bytes: 在途数据的总字节数，默认256MB，由各进程平分
+    :return: lexicon, num_lexicon, lexicon_dim, embeddings
+    """
+    lexicon = Lexicon(compact=compact)
+    num_workers = num_workers or os.cpu_count() or 1
     with open(lexicon_path, encoding='UTF-8') as f:
         num_lexicon, lexicon_dim = map(lambda x: int(x), f.readline().split())
+        embeddings = allocate((num_lexicon + 1, lexicon_dim), np.float32)
         # <UNK>的embedding, <UNK>的index为0
-        embeddings.append(np.random.normal(-1, 1, lexicon_dim).tolist())
-        # t = 0
-        for line in f:
-            # t += 1
-            # if t == 3000:
-            #     break
-            line = line.strip().split()
-            lexicon.insert(line[0], 'one_source')
-            lexicon_embedding = np.fromstring(' '.join(line[1:]), dtype=np.float32, sep=' ').tolist()
-            embeddings.append(lexicon_embedding)
+        embeddings[0] = np.random.normal(-1, 1, lexicon_dim)
+        next_id = 1
+        for words, vectors in _iter_lexicon_chunks(f, lexicon_dim, num_workers, buffer_bytes):
+            rows = []
+            ids = []
+            for i, word in enumerate(words):
+                lexicon_id = lexicon.insert(word, 'one_source')
+                if lexicon_id == next_id:
+                    rows.append(i)
+                    ids.append(lexicon_id)
+                    next_id += 1
+            if next_id > num_lexicon + 1:
+                raise ValueError('%s has more words than the %i in its header' % (lexicon_path, num_lexicon))
+            embeddings[ids] = vectors[rows]
+    if next_id - 1 < num_lexicon:
+        print('warning: %i lexicon lines are invalid or duplicated' % (num_lexicon - next_id + 1))
+    lexicon.build()
+    stat = os.stat(lexicon_path)
+    lexicon.version = '%s %i %s' % (os.path.abspath(lexicon_path), stat.st_size, stat.st_mtime)
     return lexicon, num_lexicon, lexicon_dim, embeddings
 
 
+def file_hash(path, block_size=1 << 20):
+    """
+    文件内容的sha1
+    :param path:
+    :param block_size:
+    :return:
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def lexicon_bundle_is_fresh(lexicon_path, bundle_path):
+    """
+    判断bundle是否可用：版本一致，且与lexicon文件内容一致
+    文件大小和修改时间未变时不再重新计算hash；lexicon文件不存在时直接使用bundle
+    修改时间变了但hash一致时（复制、touch等），把新的修改时间记在source_stat.json中，之后不再重复计算hash
+    source_stat.json不写入meta.json，以免改变lexicon.version使数据缓存失效
+    :param lexicon_path:
+    :param bundle_path:
+    :return:
+    """
+    meta_path = os.path.join(bundle_path, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path, encoding='UTF-8') as f:
+        meta = json.load(f)
+    if meta.get('version') != LEXICON_BUNDLE_VERSION:
+        return False
+    if not os.path.isfile(lexicon_path):
+        return True
+    stat = os.stat(lexicon_path)
+    if stat.st_size != meta['source_size']:
+        return False
+    stat_path = os.path.join(bundle_path, 'source_stat.json')
+    verified_mtimes = [meta['source_mtime']]
+    if os.path.isfile(stat_path):
+        with open(stat_path, encoding='UTF-8') as f:
+            verified = json.load(f)
+        if verified.get('source_size') == meta['source_size']:
+            verified_mtimes.append(verified.get('source_mtime'))
+    if stat.st_mtime in verified_mtimes:
+        return True
+    if file_hash(lexicon_path) != meta['source_hash']:
+        return False
+    try:
+        tmp_path = stat_path + '.tmp'
+        with open(tmp_path, 'w', encoding='UTF-8') as f:
+            json.dump({'source_size': stat.st_size, 'source_mtime': stat.st_mtime}, f)
+        os.replace(tmp_path, stat_path)
+    except OSError as e:
+        print('warning: cannot record the verified lexicon mtime in %s: %s' % (stat_path, e))
+    return True
+
+
+def build_lexicon_bundle(lexicon_path, bundle_path, num_workers=None):
+    """
+    把文本格式的lexicon编译成bundle：trie结构、id表、float32的embedding矩阵以及meta.json
+    :param lexicon_path:
+    :param bundle_path:
+    :param num_workers: 解析embedding的进程数
+    :return:
+    """
+    print('building lexicon bundle %s from %s' % (bundle_path, lexicon_path))
+    stat = os.stat(lexicon_path)
+    tmp_path = bundle_path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    embeddings_path = os.path.join(tmp_path, 'embeddings.npy')
+    lexicon, num_lexicon, lexicon_dim, embeddings = read_lexicon(
+        lexicon_path,
+        compact=True,
+        allocate=lambda shape, dtype: np.lib.format.open_memmap(embeddings_path, 'w+', dtype, shape),
+        num_workers=num_workers
+    )
+    embeddings.flush()
+    del embeddings
+    lexicon.save(tmp_path)
+    meta = {
+        'version': LEXICON_BUNDLE_VERSION,
+        'source': os.path.abspath(lexicon_path),
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'source_hash': file_hash(lexicon_path),
+        'num_lexicon': num_lexicon,
+        'lexicon_dim': lexicon_dim
+    }
+    _commit_bundle(tmp_path, bundle_path, meta)
+
+
+def _commit_bundle(tmp_path, bundle_path, meta):
+    """
+    写入meta.json，并用构建好的临时文件夹替换bundle
+    :param tmp_path:
+    :param bundle_path:
+    :param meta:
+    :return:
+    """
+    with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='UTF-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    if os.path.isdir(bundle_path):
+        shutil.rmtree(bundle_path)
+    os.rename(tmp_path, bundle_path)
+
+
+def load_lexicon_bundle(bundle_path):
+    """
+    以内存映射的方式打开bundle，返回值与get_lexicon一致，embeddings为只读的np.memmap
+    :param bundle_path:
+    :return:
+    """
+    with open(os.path.join(bundle_path, 'meta.json'), encoding='UTF-8') as f:
+        meta = json.load(f)
+    lexicon = Lexicon.load(bundle_path, mmap_mode='r')
+    lexicon.version = file_hash(os.path.join(bundle_path, 'meta.json'))
+    embeddings = np.load(os.path.join(bundle_path, 'embeddings.npy'), mmap_mode='r')
+    return lexicon, meta['num_lexicon'], meta['lexicon_dim'], embeddings
+
+
+def factorize_embeddings(embeddings, rank, chunk_rows=100000):
+    """
+    截断SVD的低秩分解 embeddings ≈ table.dot(projection)
+    分块累加X^T X再做特征分解，内存只与块大小和维度有关
+    :param embeddings: [num_rows, dim]，可以是np.memmap
+    :param rank:
+    :param chunk_rows:
+    :return: table [num_rows, rank], projection [rank, dim]，均为np.float32
+    """
+    dim = embeddings.shape[1]
+    gram = np.zeros([dim, dim], dtype=np.float64)
+    for start in range(0, len(embeddings), chunk_rows):
+        chunk = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float64)
+        gram += chunk.T.dot(chunk)
+    _, eigenvectors = np.linalg.eigh(gram)
+    # eigh按特征值升序排列，取最大的rank个右奇异向量
+    basis = eigenvectors[:, ::-1][:, :rank]
+    table = np.empty([len(embeddings), rank], dtype=np.float32)
+    for start in range(0, len(embeddings), chunk_rows):
+        table[start:start + chunk_rows] = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float64).dot(basis)
+    return table, basis.T.astype(np.float32)
+
+
+def hash_lexicon_ids(ids, num_buckets):
+    """
+    把lexicon id映射到hash桶，与Model中图内的映射一致，<UNK>(0)映射到0号桶
+    :param ids:
+    :param num_buckets:
+    :return:
+    """
+    return np.asarray(ids, dtype=np.int64) * LEXICON_HASH_MULTIPLIER % num_buckets
+
+
+def bucket_embeddings(embeddings, num_buckets, chunk_rows=100000):
+    """
+    每个hash桶的初始向量为落入该桶的预训练向量的均值
+    :param embeddings: [num_rows, dim]
+    :param num_buckets:
+    :param chunk_rows:
+    :return: [num_buckets, dim]
+    """
+    sums = np.zeros([num_buckets, embeddings.shape[1]], dtype=np.float64)
+    counts = np.zeros([num_buckets], dtype=np.int64)
+    for start in range(0, len(embeddings), chunk_rows):
+        chunk = np.asarray(embeddings[start:start + chunk_rows], dtype=np.float64)
+        buckets = hash_lexicon_ids(np.arange(start, start + len(chunk)), num_buckets)
+        np.add.at(sums, buckets, chunk)
+        counts += np.bincount(buckets, minlength=num_buckets)
+    return (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+
+
+def iter_corpus_sentences(path, raw=False):
+    """
+    逐句读取语料中的文本
+    :param path:
+    :param raw: False时为每行一个字符和标记、句子之间用空行分隔的标注文件，True时为每行一个句子的原始文本
+    :return:
+    """
+    if raw:
+        for line in open(path, encoding='UTF-8'):
+            line = line.strip()
+            if line:
+                yield line
+        return
+    sentence = []
+    for i, line in enumerate(open(path, encoding='UTF-8')):
+        line = line.split()
+        if not line:
+            if sentence:
+                yield ''.join(sentence)
+            sentence = []
+        elif len(line) < 2:
+            raise Exception('%s第%i行应为字符和标记，请检查语料格式' % (path, i + 1))
+        else:
+            sentence.append(line[0])
+    if sentence:
+        yield ''.join(sentence)
+
+
+def _pruned_lexicon_key(lexicon_path, corpus_files, raw_files=()):
+    """
+    :return: lexicon文件的标识（大小和修改时间，文件不存在时为None），语料内容及其格式的hash
+    """
+    lexicon_id = None
+    if os.path.isfile(lexicon_path):
+        stat = os.stat(lexicon_path)
+        lexicon_id = '%s %i %s' % (os.path.abspath(lexicon_path), stat.st_size, stat.st_mtime)
+    sha1 = hashlib.sha1()
+    for fmt, paths in [('column', corpus_files), ('raw', raw_files)]:
+        for path in paths:
+            sha1.update(('%s %s\n' % (fmt, file_hash(path))).encode('UTF-8'))
+    return lexicon_id, sha1.hexdigest()
+
+
+def get_pruned_lexicon(lexicon_path, corpus_files, pruned_path, bundle_path=None, num_workers=None, raw_files=()):
+    """
+    只保留语料中能匹配到的词的lexicon，词id重新连续编号，结果保存为bundle
+    语料或lexicon文件变化时重新裁剪；lexicon文件不存在时只检查语料
+    :param lexicon_path: 完整的lexicon
+    :param corpus_files: 用于裁剪的标注语料，每行一个字符和标记
+    :param pruned_path: 裁剪后的bundle文件夹
+    :param bundle_path: 完整lexicon的bundle
+    :param num_workers:
+    :param raw_files: 用于裁剪的原始文本，每行一个句子
+    :return: 与get_lexicon一致，num_lexicon为保留的词数
+    """
+    lexicon_id, corpus_hash = _pruned_lexicon_key(lexicon_path, corpus_files, raw_files)
+    meta_path = os.path.join(pruned_path, 'meta.json')
+    if os.path.isfile(meta_path):
+        with open(meta_path, encoding='UTF-8') as f:
+            meta = json.load(f)
+        if meta.get('version') == LEXICON_BUNDLE_VERSION and meta['corpus_hash'] == corpus_hash \
+                and lexicon_id in (None, meta['lexicon_id']):
+            return load_lexicon_bundle(pruned_path)
+    lexicon, num_lexicon, lexicon_dim, embeddings = get_lexicon(lexicon_path, True, bundle_path, num_workers)
+    prune_lexicon(lexicon, embeddings, corpus_files, pruned_path, {
+        'source': os.path.abspath(lexicon_path),
+        'lexicon_id': lexicon_id,
+        'corpus_files': [os.path.abspath(path) for path in corpus_files],
+        'raw_files': [os.path.abspath(path) for path in raw_files],
+        'corpus_hash': corpus_hash
+    }, raw_files)
+    return load_lexicon_bundle(pruned_path)
+
+
+def prune_lexicon(lexicon, embeddings, corpus_files, pruned_path, meta=None, raw_files=()):
+    """
+    用lexicon匹配语料，保留匹配到的词（包括作为lexicon特征补齐的单字），
+    按原id的顺序重新编号为1..n，写出新的trie和embedding矩阵
+    :param lexicon:
+    :param embeddings: [num_lexicon + 1, lexicon_dim]
+    :param corpus_files: 标注语料
+    :param pruned_path:
+    :param meta: 写入meta.json的额外信息
+    :param raw_files: 原始文本
+    :return:
+    """
+    kept = {}
+    sources = [(path, False) for path in corpus_files] + [(path, True) for path in raw_files]
+    for path, raw in sources:
+        for sentence in iter_corpus_sentences(path, raw):
+            chars = [char.lower() for char in sentence] if lexicon.lower else list(sentence)
+            for start, end, lexicon_id in lexicon.match_sentence(sentence):
+                kept[lexicon_id] = lexicon.space.join(chars[start:end])
+            for char in set(sentence):
+                lexicon_id = lexicon.search_id(char)
+                if lexicon_id != 0:
+                    kept[lexicon_id] = char.lower() if lexicon.lower else char
+    old_ids = sorted(kept)
+    print('pruned lexicon from %i to %i words' % (lexicon.size(), len(old_ids)))
+
+    pruned = Lexicon(lower=lexicon.lower, compact=True)
+    pruned.space = lexicon.space
+    for lexicon_id in old_ids:
+        pruned.insert(kept[lexicon_id], lexicon.search_type(kept[lexicon_id]))
+    pruned.build()
+
+    tmp_path = pruned_path + '.tmp'
+    if os.path.isdir(tmp_path):
+        shutil.rmtree(tmp_path)
+    pruned.save(tmp_path)
+    pruned_embeddings = np.empty([len(old_ids) + 1, embeddings.shape[1]], dtype=np.float32)
+    pruned_embeddings[0] = embeddings[0]
+    pruned_embeddings[1:] = embeddings[old_ids]
+    np.save(os.path.join(tmp_path, 'embeddings.npy'), pruned_embeddings)
+    meta = dict(meta or {})
+    meta.update({
+        'version': LEXICON_BUNDLE_VERSION,
+        'num_lexicon': len(old_ids),
+        'lexicon_dim': int(embeddings.shape[1]),
+        'pruned_from': lexicon.size()
+    })
+    _commit_bundle(tmp_path, pruned_path, meta)
+
+
 if __name__ == '__main__':
-    num_lexicon, lexicon_dim, embeddings = get_lexicon('./data/sgns.merge.word')
-    print(num_lexicon)
-    print(lexicon_dim)
-    print(type(embeddings))
-    print(np.asarray(embeddings).shape)
+    # 预先构建lexicon bundle，之后main.py直接内存映射打开
+    lexicon_path = os.path.join('data', 'sgns.merge.word')
+    build_lexicon_bundle(lexicon_path, lexicon_path + '.bundle')
@@ -7,9 +7,10 @@ import tensorflow as tf
 import data_loader
 import model_utils
 import pickle
-import data_utils
 import itertools
+import data_utils
 from model import Model
+from utils.seg_cache import SegCache
 from data_utils import load_word2vec
 import numpy as np
 import time
@@ -29,10 +30,17 @@ flags.DEFINE_string('tag_schema', 'BIOES', 'encoding method')
 
 # training parameters
 flags.DEFINE_float('clip', 5, 'Gradient clip')
+flags.DEFINE_string('clip_mode', 'value', 'clip gradients by value or by global norm')
 flags.DEFINE_float('dropout', 0.5, 'Dropout tate')
 flags.DEFINE_integer('batch_size', 128, 'batch size')
+flags.DEFINE_string('input_pipeline', 'dataset', 'feed training batches through tf.data with prefetch, or feed_dict for debugging')
+flags.DEFINE_integer('prefetch_batches', 2, 'num of batches prepared in background by tf.data')
+flags.DEFINE_integer('eval_threads', 2, 'num of batches run concurrently while decoding during evaluation')
+flags.DEFINE_integer('max_tokens', 0, 'max padded tokens per batch, 0 to batch by batch_size sentences')
+flags.DEFINE_integer('pack_length', 0, 'pack short sentences into rows of at most this many tokens, 0 to disable')
 flags.DEFINE_float('lr', 0.015, 'learning rate')
 flags.DEFINE_string('optimizer', 'sgd', 'optimizer')
+flags.DEFINE_boolean('sparse_update', False, 'Are you update only the embedding rows in the batch (lazy adam)?')
 flags.DEFINE_boolean('pre_emb', True, 'Are you train word embedding?')
 
 flags.DEFINE_integer('max_epoch', 100, 'num of training')
@@ -42,28 +50,62 @@ flags.DEFINE_string('log_file', 'train.log', 'the log of training')
 flags.DEFINE_string('map_file', 'maps.pkl', 'dictionary of tag and word')
 flags.DEFINE_string('vocab_file', 'vocab.json', 'word embedding')
 flags.DEFINE_string('config_file', 'config_file', 'config file')
+flags.DEFINE_integer('prepare_workers', 1, 'num of processes used to prepare dataset')
+flags.DEFINE_integer('prepare_chunk_size', 1000, 'num of sentences per task when preparing dataset in processes')
+flags.DEFINE_integer('chunk_bytes', 1 << 24, 'bytes of corpus counted per task when building maps')
+flags.DEFINE_string('seg_backend', 'jieba', 'segmentation feature from jieba or from lexicon maximum matching')
+flags.DEFINE_string('seg_cache', 'seg_cache.sqlite', 'persistent cache of segmentation features, empty to disable')
+flags.DEFINE_boolean('stream_train', False, 'Are you stream training data from shards instead of loading it into memory?')
+flags.DEFINE_integer('shuffle_buffer', 10000, 'num of sentences bucketed and shuffled together when streaming')
+flags.DEFINE_string('data_cache', 'cache', 'the path of prepared dataset cache, empty to disable')
+flags.DEFINE_integer('lexicon_pad_seed', 0, 'seed of padding lexicon feature with random chars')
 flags.DEFINE_string('result_path', 'result', 'the path of result')
 flags.DEFINE_string('emb_file', os.path.join('data', 'gigaword_chn.all.a2b.uni.ite50.vec'), 'the path of word embedding')
 flags.DEFINE_string('train_file', os.path.join('data', 'train.char.bmes'), 'the path of training data')
 flags.DEFINE_string('dev_file', os.path.join('data', 'dev.char.bmes'), 'the path of dev data')
 flags.DEFINE_string('test_file', os.path.join('data', 'test.char.bmes'), 'the path of test data')
 flags.DEFINE_string('lexicon_file', os.path.join('data', 'sgns.merge.word'), 'the path if lexicon data')
+flags.DEFINE_string('lexicon_bundle', os.path.join('data', 'sgns.merge.word.bundle'), 'the path of prebuilt lexicon bundle, empty to disable')
 
 # lexicon
 flags.DEFINE_boolean('pre_lexicon', True, 'Are you use lexicon embedding?')
 flags.DEFINE_boolean('lexicon', True, 'Are you use lexicon?')
+flags.DEFINE_boolean('prune_lexicon', False, 'Are you keep only the lexicon words matched in the corpora?')
+flags.DEFINE_string('pruned_lexicon', os.path.join('data', 'sgns.merge.word.pruned'), 'the path of pruned lexicon bundle')
+flags.DEFINE_string('extra_corpus', '', 'extra raw text (one sentence per line) kept by lexicon pruning')
+flags.DEFINE_string('lexicon_compression', 'none', 'store lexicon embedding as none, factorized or hashed')
+flags.DEFINE_integer('lexicon_rank', 64, 'rank of factorized or hashed lexicon embedding')
+flags.DEFINE_integer('lexicon_buckets', 100000, 'num of buckets of hashed lexicon embedding')
+flags.DEFINE_string('embedding_precision', 'float32', 'storage of embedding tables when not training: float32, float16 or int8')
+flags.DEFINE_boolean('freeze_lexicon', False, 'Are you freeze lexicon embedding and keep it out of checkpoints?')
+flags.DEFINE_boolean('compact_lexicon', True, 'Are you use array-backed trie for lexicon?')
 
 FLAGS = tf.app.flags.FLAGS
 
 assert FLAGS.clip < 5.1, 'error'
 assert 0 < FLAGS.dropout < 1, 'the dropout between 0 and 1'
 assert FLAGS.lr > 0, 'the lr must up 0'
+assert FLAGS.pre_lexicon or not FLAGS.freeze_lexicon, 'a frozen lexicon must use pretrained lexicon embedding'
+assert FLAGS.lexicon_compression in ['none', 'factorized', 'hashed'], \
+    'the lexicon_compression must in [none factorized hashed]'
+assert FLAGS.embedding_precision in ['float32', 'float16', 'int8'], \
+    'the embedding_precision must in [float32 float16 int8]'
+assert FLAGS.seg_backend in ['jieba', 'lexicon'], 'the seg_backend must in [jieba lexicon]'
+assert FLAGS.input_pipeline in ['dataset', 'feed_dict'], 'the input_pipeline must in [dataset feed_dict]'
+assert FLAGS.prefetch_batches > 0, 'prefetch_batches must be positive'
+assert FLAGS.eval_threads > 0, 'eval_threads must be positive'
+assert FLAGS.max_tokens >= 0, 'max_tokens must not be negative'
+assert FLAGS.pack_length >= 0, 'pack_length must not be negative'
+assert FLAGS.shuffle_buffer >= FLAGS.batch_size, 'shuffle_buffer must be at least batch_size'
+assert FLAGS.clip_mode in ['value', 'norm'], 'the clip_mode must in [value norm]'
 assert FLAGS.optimizer in ['adam', 'sgd', 'adagrad'], 'the optimizer must in [adam sgd adagrad]'
 
 
 def evaluate(sess, model, name, manager, id_to_tag, logger):
     logger.info('evaluate:{}'.format(name))
+    eval_start = time.time()
     ner_results = model.evaluate(sess, manager, id_to_tag)
+    logger.info('evaluate time: {:.2f}s, eval threads: {}'.format(time.time() - eval_start, model.config.get('eval_threads', 1)))
     eval_lines = model_utils.test_ner(ner_results, FLAGS.result_path)
     for line in eval_lines:
         logger.info(line)
@@ -85,94 +127,224 @@ def evaluate(sess, model, name, manager, id_to_tag, logger):
         return f1 > best_test_f1
 
 
+def load_lexicon():
+    """
+    加载lexicon，prune_lexicon时只保留语料中能匹配到的词
+    :return:
+    """
+    if FLAGS.prune_lexicon:
+        # 训练、验证、测试集为标注格式，extra_corpus为每行一个句子的原始文本
+        corpus_files = data_loader.expand_shards(FLAGS.train_file) + [FLAGS.dev_file, FLAGS.test_file]
+        raw_files = [FLAGS.extra_corpus] if FLAGS.extra_corpus else []
+        return data_utils.get_pruned_lexicon(
+            FLAGS.lexicon_file, corpus_files, FLAGS.pruned_lexicon, FLAGS.lexicon_bundle, raw_files=raw_files
+        )
+    return data_utils.get_lexicon(FLAGS.lexicon_file, FLAGS.compact_lexicon, FLAGS.lexicon_bundle)
+
+
+def load_seg_cache(seg_backend):
+    """
+    :return: 分词缓存，seg_cache为空或不使用结巴分词时返回None
+    """
+    if not FLAGS.seg_cache or seg_backend != 'jieba':
+        return None
+    return SegCache(FLAGS.seg_cache, data_utils.jieba_version())
+
+
+def load_dataset(path, word_to_id, tag_to_id, lexicon, seg_cache, seg_backend):
+    """
+    加载预处理后的数据集，data_cache不为空时优先从缓存读取
+    :return:
+    """
+    return data_loader.load_dataset(
+        path, FLAGS.tag_schema, word_to_id, tag_to_id, lexicon, FLAGS.map_file, cache_dir=FLAGS.data_cache,
+        seg_cache=seg_cache, num_workers=FLAGS.prepare_workers, chunk_size=FLAGS.prepare_chunk_size,
+        seg_backend=seg_backend, seed=FLAGS.lexicon_pad_seed
+    )
+
+
 def train():
-    # 加载数据集
-    train_sentences = data_loader.load_sentences(FLAGS.train_file)
-    dev_sentences = data_loader.load_sentences(FLAGS.dev_file)
-    test_sentences = data_loader.load_sentences(FLAGS.test_file)
+    # 创建不存在的文件夹
+    model_utils.make_path(FLAGS)
 
-    # 转换编码
-    data_loader.update_tag_scheme(train_sentences, FLAGS.tag_schema)
-    data_loader.update_tag_scheme(dev_sentences, FLAGS.tag_schema)
-    data_loader.update_tag_scheme(test_sentences, FLAGS.tag_schema)
+    # 配置印logger
+    log_path = os.path.join('log', FLAGS.log_file)
+    logger = model_utils.get_logger(log_path)
 
     # 创建单词和词典映射
     if not os.path.isfile(FLAGS.map_file):
-        if FLAGS.pre_emb:
-            dico_words_train = data_loader.word_mapping(train_sentences)[0]
-            dico_word, word_to_id, id_to_word = data_utils.augment_with_pretrained(
-                dico_words_train.copy(),
-                FLAGS.emb_file,
-                list(
-                    itertools.chain.from_iterable([[w[0] for w in s] for s in test_sentences])
-                )
-            )
-        else:
-            _, word_to_id, id_to_word = data_loader.word_mapping(train_sentences)
-        _, tag_to_id, id_to_tag = data_loader.tag_mapping(train_sentences)
-        with open(FLAGS.map_file, 'wb') as f:
-            pickle.dump([word_to_id, id_to_word, tag_to_id, id_to_tag], f)
+        map_start = time.time()
+        word_to_id, id_to_word, tag_to_id, id_to_tag = data_loader.build_maps(
+            data_loader.expand_shards(FLAGS.train_file), FLAGS.tag_schema, FLAGS.map_file,
+            test_files=[FLAGS.test_file], emb_file=FLAGS.emb_file if FLAGS.pre_emb else None, word_dim=FLAGS.word_dim,
+            num_workers=FLAGS.prepare_workers, chunk_bytes=FLAGS.chunk_bytes
+        )
+        logger.info('build %s: %i words, %i tags, %.2fs' % (
+            FLAGS.map_file, len(word_to_id), len(tag_to_id), time.time() - map_start))
     else:
         with open(FLAGS.map_file, 'rb') as f:
             word_to_id, id_to_word, tag_to_id, id_to_tag = pickle.load(f)
     # 准备lexcion
-    lexicon, num_lexicon, lexicon_dim, lexicon_embeddings = data_utils.get_lexicon(FLAGS.lexicon_file)
+    lexicon, num_lexicon, lexicon_dim, lexicon_embeddings = load_lexicon()
 
     # 准备数据
-    train_data = data_loader.prepare_dataset(train_sentences, word_to_id, tag_to_id, lexicon)
-    dev_data = data_loader.prepare_dataset(dev_sentences, word_to_id, tag_to_id, lexicon)
-    test_data = data_loader.prepare_dataset(test_sentences, word_to_id, tag_to_id, lexicon)
+    prepare_start = time.time()
+    seg_cache = load_seg_cache(FLAGS.seg_backend)
+    if FLAGS.stream_train:
+        train_data = None
+    else:
+        train_data = load_dataset(FLAGS.train_file, word_to_id, tag_to_id, lexicon, seg_cache, FLAGS.seg_backend)
+    dev_data = load_dataset(FLAGS.dev_file, word_to_id, tag_to_id, lexicon, seg_cache, FLAGS.seg_backend)
+    test_data = load_dataset(FLAGS.test_file, word_to_id, tag_to_id, lexicon, seg_cache, FLAGS.seg_backend)
+    prepare_time = time.time() - prepare_start
 
     # 将数据分批处理
-    train_manager = data_utils.BatchManager(train_data, FLAGS.batch_size)
-    dev_manager = data_utils.BatchManager(dev_data, FLAGS.batch_size)
-    test_manager = data_utils.BatchManager(test_data, FLAGS.batch_size)
-
-    # 创建不存在的文件夹
-    model_utils.make_path(FLAGS)
+    if FLAGS.stream_train:
+        # 训练集边训练边处理，分词缓存在训练过程中继续使用
+        train_manager = data_loader.StreamingBatchManager(
+            data_loader.expand_shards(FLAGS.train_file), FLAGS.tag_schema, word_to_id, tag_to_id, lexicon,
+            FLAGS.batch_size, FLAGS.shuffle_buffer, seg_cache=seg_cache, seg_backend=FLAGS.seg_backend,
+            seed=FLAGS.lexicon_pad_seed, max_tokens=FLAGS.max_tokens, pack_length=FLAGS.pack_length
+        )
+    else:
+        train_manager = data_utils.BatchManager(train_data, FLAGS.batch_size, FLAGS.max_tokens, FLAGS.pack_length)
+    dev_manager = data_utils.BatchManager(dev_data, FLAGS.batch_size, FLAGS.max_tokens, FLAGS.pack_length)
+    test_manager = data_utils.BatchManager(test_data, FLAGS.batch_size, FLAGS.max_tokens, FLAGS.pack_length)
 
     # 判断配置文件
     if os.path.isfile(FLAGS.config_file):
         config = model_utils.load_config(FLAGS.config_file)
     else:
-        config = model_utils.config_model(FLAGS, word_to_id, tag_to_id)
+        config = model_utils.config_model(FLAGS, word_to_id, tag_to_id, len(lexicon_embeddings))
         model_utils.save_config(config, FLAGS.config_file)
+    assert config['num_lexicon'] == len(lexicon_embeddings), \
+        'num_lexicon in %s does not match the lexicon, remove the config file' % FLAGS.config_file
+    # 打包和评估的线程数只改变运行方式，不影响参数，以命令行为准
+    config['pack_length'] = FLAGS.pack_length
+    config['eval_threads'] = FLAGS.eval_threads
 
-    # 配置印logger
-    log_path = os.path.join('log', FLAGS.log_file)
-    logger = model_utils.get_logger(log_path)
     model_utils.print_config(config, logger)
+    logger.info('lexicon size: %i, lexicon index memory: %.1f MB' % (lexicon.size(), lexicon.memory_usage() / 2 ** 20))
+    logger.info('prepare dataset (seg backend: %s): %.2fs' % (FLAGS.seg_backend, prepare_time))
+    managers = [dev_manager, test_manager] if FLAGS.stream_train else [train_manager, dev_manager, test_manager]
+    logger.info('padded batch memory: %.1f MB' % (sum(manager.nbytes() for manager in managers) / 2 ** 20))
+    if FLAGS.stream_train:
+        logger.info('streaming train corpus: %i shards, %i sentences, shuffle buffer %i' % (
+            len(train_manager.shards), train_manager.num_sentences, FLAGS.shuffle_buffer))
+    for name, data in [('train', train_data), ('dev', dev_data), ('test', test_data)]:
+        if data is None:
+            continue
+        logger.info('%s corpus: %i sentences, %i tokens, %.1f MB' % (name, len(data), data.num_tokens(), data.nbytes() / 2 ** 20))
+    if seg_cache is not None:
+        seg_cache.flush()
+        logger.info(seg_cache.report())
+        seg_cache.close()
 
     tf_config = tf.ConfigProto(allow_soft_placement=True)
     tf_config.gpu_options.allow_growth = True
 
-    step_per_epoch = train_manager._len_data
     with tf.Session(config=tf_config) as sess:  
-        model = model_utils.create(sess, Model, FLAGS.ckpt_path, load_word2vec, config, id_to_word, logger, lexicon_embeddings)
+        iterator, inputs = None, None
+        if FLAGS.input_pipeline == 'dataset':
+            iterator, inputs = model_utils.create_input_pipeline(
+                train_manager, FLAGS.pack_length > 0, FLAGS.prefetch_batches
+            )
+        model = model_utils.create(sess, Model, FLAGS.ckpt_path, load_word2vec, config, id_to_word, logger,
+                                   lexicon_embeddings, inputs)
+        logger.info('input pipeline: %s' % FLAGS.input_pipeline)
+        logger.info('optimizer slot memory: %.1f MB' % (model.optimizer_slot_bytes() / 2 ** 20))
         logger.info('开始训练')
         loss = []
+        step_time = []
+        # 取batch和构造feed_dict的时间，即每步在主机上的开销
+        host_time = []
+        step_tokens = []
         start = time.time()
         for i in range(100):
-            for batch in train_manager.iter_batch(shuffle=True):
-                step, batch_loss = model.run_step(sess, True, batch)
+            # 流式按token数分batch时，每轮的batch数在跑完一轮后才确定
+            step_per_epoch = train_manager._len_data
+            if iterator is None:
+                batches = train_manager.iter_batch(shuffle=True)
+            else:
+                # batch由iterator在后台准备，读完一轮时sess.run抛出OutOfRangeError
+                sess.run(iterator.initializer)
+                batches = itertools.repeat(None)
+            host_start = time.time()
+            for batch in batches:
+                step_start = time.time()
+                feed_dict = model.create_feed_dict(True, batch)
+                host_time.append(time.time() - host_start)
+                try:
+                    step, batch_loss = model.run_step(sess, True, batch, feed_dict)
+                except tf.errors.OutOfRangeError:
+                    host_time.pop()
+                    break
+                step_time.append(time.time() - step_start)
+                step_tokens.append(model.last_step_tokens)
                 loss.append(batch_loss)
                 if step % FLAGS.setps_chech == 0:
                     iteration = step // step_per_epoch + 1
-                    logger.info("iteration{}: step{}/{}, NER loss:{:>9.6f}".format(iteration, step % step_per_epoch,
-                                                                                   step_per_epoch, np.mean(loss)))
+                    logger.info("iteration{}: step{}/{}, NER loss:{:>9.6f}, step time:{:>7.1f}ms, host time:{:>7.3f}ms, "
+                                "{:>8.0f} tokens/s".format(
+                                    iteration, step % step_per_epoch, step_per_epoch, np.mean(loss), 1000 * np.mean(step_time),
+                                    1000 * np.mean(host_time), np.sum(step_tokens) / np.sum(step_time)))
                     loss = []
+                    step_time = []
+                    host_time = []
+                    step_tokens = []
+                host_start = time.time()
             best = evaluate(sess, model, 'dev', dev_manager, id_to_tag, logger)
 
             if best:
-                pass
-                # model_utils.save_model(sess, model, FLAGS.ckpt_path, logger)
+                model_utils.save_model(sess, model, FLAGS.ckpt_path, logger)
             evaluate(sess, model, 'test', test_manager, id_to_tag, logger)
         t = time.time() - start
         logger.info('cost time: %f' % t)
 
 
+def test():
+    """
+    加载保存的模型在测试集上评估，embedding_precision为float16或int8时embedding表以低精度存储
+    :return:
+    """
+    with open(FLAGS.map_file, 'rb') as f:
+        word_to_id, id_to_word, tag_to_id, id_to_tag = pickle.load(f)
+    config = model_utils.load_config(FLAGS.config_file)
+    config['embedding_precision'] = FLAGS.embedding_precision
+    config['pack_length'] = FLAGS.pack_length
+    config['eval_threads'] = FLAGS.eval_threads
+
+    assert config.get('prune_lexicon', FLAGS.prune_lexicon) == FLAGS.prune_lexicon, \
+        'the model was trained with prune_lexicon=%s, use the same setting' % config['prune_lexicon']
+    lexicon, num_lexicon, lexicon_dim, lexicon_embeddings = load_lexicon()
+    assert config['num_lexicon'] == len(lexicon_embeddings), \
+        'num_lexicon in %s does not match the lexicon, use the lexicon settings of training' % FLAGS.config_file
+    seg_backend = config.get('seg_backend', 'jieba')
+    seg_cache = load_seg_cache(seg_backend)
+    test_data = load_dataset(FLAGS.test_file, word_to_id, tag_to_id, lexicon, seg_cache, seg_backend)
+    test_manager = data_utils.BatchManager(test_data, FLAGS.batch_size, FLAGS.max_tokens, FLAGS.pack_length)
+
+    model_utils.make_path(FLAGS)
+    logger = model_utils.get_logger(os.path.join('log', FLAGS.log_file))
+    if seg_cache is not None:
+        seg_cache.flush()
+        logger.info(seg_cache.report())
+        seg_cache.close()
+    assert tf.train.get_checkpoint_state(FLAGS.ckpt_path), 'no model in %s' % FLAGS.ckpt_path
+
+    tf_config = tf.ConfigProto(allow_soft_placement=True)
+    tf_config.gpu_options.allow_growth = True
+    with tf.Session(config=tf_config) as sess:
+        model = model_utils.create(sess, Model, FLAGS.ckpt_path, load_word2vec, config, id_to_word, logger, lexicon_embeddings)
+        logger.info('embedding precision: %s' % FLAGS.embedding_precision)
+        evaluate(sess, model, 'test', test_manager, id_to_tag, logger)
+
+
 def main(_):
-    train()
+    if FLAGS.train:
+        train()
+    else:
+        test()
 
 
 if __name__ == '__main__':
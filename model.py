@@ -2,18 +2,57 @@
 # -*- coding: UTF-8 -*-
 __author__ = 'zd'
 
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from tensorflow.contrib.layers.python.layers import initializers
 import tensorflow.contrib.rnn as rnn
 from tensorflow.contrib.crf import crf_log_likelihood
 import numpy as np
-from tensorflow.contrib.crf import viterbi_decode
+from tensorflow.python.util import nest
 import data_utils
+from utils.viterbi import viterbi_decode_batch
+
+
+class ResetStateCell(tf.nn.rnn_cell.RNNCell):
+    """
+    打包输入时在句子边界把状态清零，输入的最后两维为前向和后向的清零标记
+    变量名与被包装的cell一致，打包与否可以使用同一个checkpoint
+    """
+    def __init__(self, cell, flag_index):
+        """
+        :param cell:
+        :param flag_index: 使用的标记，-2为前向（句首），-1为后向（句尾）
+        """
+        super(ResetStateCell, self).__init__()
+        self._cell = cell
+        self._flag_index = flag_index
+
+    @property
+    def state_size(self):
+        return self._cell.state_size
+
+    @property
+    def output_size(self):
+        return self._cell.output_size
+
+    def zero_state(self, batch_size, dtype):
+        return self._cell.zero_state(batch_size, dtype)
+
+    def __call__(self, inputs, state, scope=None):
+        keep = 1.0 - inputs[:, self._flag_index:self._flag_index + 1 if self._flag_index < -1 else None]
+        state = nest.map_structure(lambda x: x * keep, state)
+        return self._cell(inputs[:, :-2], state, scope)
 
 
 class Model(object):
-    def __init__(self, config):
+    def __init__(self, config, inputs=None):
+        """
+        :param config:
+        :param inputs: tf.data iterator的输出，不为空时占位符默认取iterator的下一个batch，仍可以用feed_dict覆盖
+        """
         self.config = config
+        self.inputs = inputs
         self.lr = config['lr']
         self.word_dim = config['word_dim']
         self.lstm_dim = config['lstm_dim']
@@ -30,12 +69,14 @@ class Model(object):
         self.best_dev_f1 = tf.Variable(0.0, trainable=False)
         self.best_test_f1 = tf.Variable(0.0, trainable=False)
         self.initializer = initializers.xavier_initializer()
+        # 低精度存储的embedding表 [(checkpoint中的变量名, 表, 每行的scale或None)]
+        self.quantized_tables = []
 
         # 申请占位符
-        self.word_inputs = tf.placeholder(dtype=tf.int32, shape=[None, None], name='wordInputs')
-        self.seg_inputs = tf.placeholder(dtype=tf.int32, shape=[None, None], name='segInputs')
-        self.lexicon_inputs = tf.placeholder(dtype=tf.int32, shape=[None, None], name='lexiconInputs')
-        self.targets = tf.placeholder(dtype=tf.int32, shape=[None, None], name='targets')
+        self.word_inputs = self.input_placeholder('word_inputs', 'wordInputs')
+        self.seg_inputs = self.input_placeholder('seg_inputs', 'segInputs')
+        self.lexicon_inputs = self.input_placeholder('lexicon_inputs', 'lexiconInputs')
+        self.targets = self.input_placeholder('targets', 'targets')
         self.dropout = tf.placeholder(dtype=tf.float32, name='dropout')
 
         used = tf.sign(tf.abs(self.word_inputs))
@@ -43,6 +84,13 @@ class Model(object):
         self.lengths = tf.cast(length, tf.int32)
         self.batch_size = tf.shape(self.word_inputs)[0]
         self.sentence_length = tf.shape(self.word_inputs)[-1]
+        # 每行的长度，不打包时与每句的长度相同
+        self.row_lengths = self.lengths
+
+        # 打包模式：word_inputs和seg_inputs为几个句子拼接成的行，lexicon_inputs和targets仍按句子补齐
+        self.packed = config.get('pack_length', 0) > 0
+        if self.packed:
+            self.pack_inputs()
 
         # embedding层单词和分词信息
         embedding = self.embedding_layer(self.word_inputs, self.seg_inputs, self.lexicon_inputs, config)
@@ -51,13 +99,18 @@ class Model(object):
         lstm_inputs = tf.nn.dropout(embedding, self.dropout)
 
         # bilstm输出层
-        lstm_outputs = self.biLSTM_layer(lstm_inputs, self.lstm_dim, self.lengths)
+        lstm_outputs = self.biLSTM_layer(lstm_inputs, self.lstm_dim, self.row_lengths)
 
         # 投影层
         self.logits = self.project_layer(lstm_outputs)
+        if self.packed:
+            self.logits = self.unpack(self.logits)
 
         # 损失层
         self.loss = self.crf_loss_layer(self.logits, self.lengths)
+        self.num_tokens = tf.reduce_sum(self.lengths)
+        # 最近一次训练的token数，使用iterator时主机上拿不到batch
+        self.last_step_tokens = 0
 
         with tf.variable_scope('optimizer'):
             optimizer = self.config['optimizer']
@@ -65,16 +118,156 @@ class Model(object):
                 self.opt = tf.train.GradientDescentOptimizer(self.lr)
             elif optimizer == 'adam':
                 self.opt = tf.train.AdamOptimizer(self.lr)
-            elif optimizer == 'adgrad':
-                self.opt = tf.train.AdagradDAOptimizer(self.lr)
+            elif optimizer == 'adagrad':
+                # Adagrad对IndexedSlices本身就是稀疏更新
+                self.opt = tf.train.AdagradOptimizer(self.lr)
             else:
                 raise Exception('优化器错误')
             grad_vars = self.opt.compute_gradients(self.loss)
-            capped_grad_vars = [[tf.clip_by_value(g, -self.config['clip'], self.config['clip']),v] for g, v in grad_vars]
-            self.train_op = self.opt.apply_gradients(capped_grad_vars, self.global_step)
+            capped_grad_vars = self.clip_gradients(grad_vars)
+            self.optimizers = [self.opt]
+            if self.config.get('sparse_update', False) and optimizer == 'adam':
+                # embedding表使用lazy adam，只更新batch中出现的行及其slot，其余层正常更新
+                embedding_names = set(v.name for v in self.embedding_variables())
+                dense_grad_vars = [gv for gv in capped_grad_vars if gv[1].name not in embedding_names]
+                sparse_grad_vars = [gv for gv in capped_grad_vars if gv[1].name in embedding_names]
+                self.embedding_opt = tf.contrib.opt.LazyAdamOptimizer(self.lr)
+                self.optimizers.append(self.embedding_opt)
+                self.train_op = tf.group(
+                    self.opt.apply_gradients(dense_grad_vars, self.global_step),
+                    self.embedding_opt.apply_gradients(sparse_grad_vars)
+                )
+            else:
+                self.train_op = self.opt.apply_gradients(capped_grad_vars, self.global_step)
+
+            # 保存模型，冻结的lexicon表不写入checkpoint，恢复时从lexicon向量重新加载
+            self.saver = tf.train.Saver(self.saved_variables(), max_to_keep=5)
+
+    def input_placeholder(self, key, name):
+        """
+        :param key: inputs中的名字
+        :param name: 占位符的名字
+        :return: [batch_size, sentence_length]的int32占位符
+        """
+        if self.inputs is None:
+            return tf.placeholder(dtype=tf.int32, shape=[None, None], name=name)
+        return tf.placeholder_with_default(self.inputs[key], shape=[None, None], name=name)
+
+    def pack_inputs(self):
+        """
+        pack_index为每个句子每个位置在展平的打包数组中的下标，补齐位置为-1
+        由它得到每句的长度、每个打包位置所属的句子以及句首和句尾的清零标记
+        :return:
+        """
+        self.pack_index = self.input_placeholder('pack_index', 'packIndex')
+        mask = self.pack_index >= 0
+        self.lengths = tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+        self.batch_size = tf.shape(self.pack_index)[0]
+        self.sentence_length = tf.shape(self.pack_index)[1]
+        num_positions = tf.size(self.word_inputs)
+
+        positions = tf.where(mask)
+        sentence_ids = tf.cast(positions[:, 0], tf.int32)
+        flat_positions = tf.expand_dims(tf.gather_nd(self.pack_index, positions), 1)
+        self.position_sentence = tf.reshape(
+            tf.scatter_nd(flat_positions, sentence_ids, [num_positions]), tf.shape(self.word_inputs)
+        )
+        sentences = tf.range(self.batch_size)
+        starts = self.pack_index[:, 0]
+        ends = tf.gather_nd(self.pack_index, tf.stack([sentences, self.lengths - 1], axis=1))
+        self.reset_flags = tf.stack(
+            [tf.reshape(tf.scatter_nd(tf.expand_dims(index, 1), tf.ones([self.batch_size]), [num_positions]),
+                        tf.shape(self.word_inputs)) for index in [starts, ends]],
+            axis=-1
+        )
+
+    def unpack(self, packed):
+        """
+        :param packed: [num_rows, row_length, dim]
+        :return: [batch_size, sentence_length, dim]，补齐位置为0
+        """
+        dim = tf.shape(packed)[-1]
+        values = tf.gather(tf.reshape(packed, [-1, dim]), tf.maximum(self.pack_index, 0))
+        return values * tf.expand_dims(tf.cast(self.pack_index >= 0, values.dtype), -1)
+
+    def broadcast_sentence_feature(self, feature):
+        """
+        把每句一个的向量放到句子的每个位置
+        :param feature: [batch_size, dim]
+        :return: 与word_inputs对应的[rows, row_length, dim]
+        """
+        if self.packed:
+            return tf.gather(feature, self.position_sentence)
+        feature = tf.expand_dims(feature, axis=1)
+        return tf.tile(feature, multiples=[1, self.sentence_length, 1])
+
+    def embedding_variables(self):
+        """
+        查表得到的embedding变量，梯度为IndexedSlices
+        :return:
+        """
+        variables = [self.word_lookup]
+        if self.config['lexicon']:
+            variables.append(self.lexicon_lookup)
+        return variables
+
+    def saved_variables(self):
+        """
+        需要写入checkpoint的变量
+        :return:
+        """
+        excluded = set(v.name for v in self.quantized_variables())
+        if self.config.get('freeze_lexicon', False):
+            excluded.update(v.name for v in self.lexicon_variables())
+        return [v for v in tf.global_variables() if v.name not in excluded]
+
+    def optimizer_slot_bytes(self):
+        """
+        优化器slot变量占用的内存（字节）
+        :return:
+        """
+        total = 0
+        for opt in self.optimizers:
+            for slot_name in opt.get_slot_names():
+                for var in tf.global_variables():
+                    slot = opt.get_slot(var, slot_name)
+                    if slot is not None:
+                        total += slot.shape.num_elements() * slot.dtype.base_dtype.size
+        return total
 
-            # 保存模型
-            self.saver = tf.train.Saver(tf.global_variables(), max_to_keep=5)
+    def clip_gradients(self, grad_vars):
+        """
+        梯度裁剪，embedding_lookup产生的IndexedSlices保持稀疏，每步只更新batch中出现的行
+        clip_mode为value时逐元素裁剪，为norm时按全局范数裁剪
+        :param grad_vars: compute_gradients的结果
+        :return:
+        """
+        clip = self.config['clip']
+        grad_vars = [(self._merge_duplicate_slices(g), v) for g, v in grad_vars if g is not None]
+        if self.config.get('clip_mode', 'value') == 'norm':
+            grads, _ = tf.clip_by_global_norm([g for g, _ in grad_vars], clip)
+            return [[g, v] for g, (_, v) in zip(grads, grad_vars)]
+        capped_grad_vars = []
+        for g, v in grad_vars:
+            if isinstance(g, tf.IndexedSlices):
+                g = tf.IndexedSlices(tf.clip_by_value(g.values, -clip, clip), g.indices, g.dense_shape)
+            else:
+                g = tf.clip_by_value(g, -clip, clip)
+            capped_grad_vars.append([g, v])
+        return capped_grad_vars
+
+    @staticmethod
+    def _merge_duplicate_slices(grad):
+        """
+        合并IndexedSlices中重复的行，使稀疏裁剪与对稠密梯度裁剪的结果一致
+        :param grad:
+        :return:
+        """
+        if not isinstance(grad, tf.IndexedSlices):
+            return grad
+        unique_indices, positions = tf.unique(grad.indices)
+        values = tf.unsorted_segment_sum(grad.values, positions, tf.shape(unique_indices)[0])
+        return tf.IndexedSlices(values, unique_indices, grad.dense_shape)
 
     def embedding_layer(self, word_inputs, seg_inputs, lexicon_inputs, config, name=None):
         """
@@ -87,35 +280,22 @@ class Model(object):
         """
         embedding = []
         with tf.variable_scope('word_embedding' if not name else name):
-            self.word_lookup = tf.get_variable(
-                name='word_embedding',
-                shape=[self.num_words, self.word_dim],
-                initializer=self.initializer
-            )
-            embedding.append(tf.nn.embedding_lookup(self.word_lookup, word_inputs))
+            self.word_lookup, lookup = self.embedding_table('word_embedding', [self.num_words, self.word_dim])
+            embedding.append(lookup(word_inputs))
 
             if config['lexicon']:
                 with tf.variable_scope('lexicon_embedding'):
-                    self.lexicon_lookup = tf.get_variable(
-                        name='lexicon_embedding',
-                        shape=[self.num_lexicon, self.lexicon_dim],
-                        initializer=self.initializer
-                    )
-                    lexicon_features = tf.nn.embedding_lookup(self.lexicon_lookup, lexicon_inputs)
+                    lexicon_features = self.lexicon_embedding_lookup(lexicon_inputs, config)
                     self.gaz_length = tf.shape(lexicon_features)[1]
                     # statical information
                     prob = tf.fill(dims=tf.shape(lexicon_features), value=1.0 / tf.cast(self.gaz_length, tf.float32))
                     s_info = tf.math.multiply(lexicon_features, prob)
                     s_info = tf.reduce_sum(s_info, axis=1)
-                    s_info = tf.expand_dims(s_info, axis=1)
-                    s_info = tf.tile(s_info, multiples=[1, self.sentence_length, 1])
-                    embedding.append(s_info)
+                    embedding.append(self.broadcast_sentence_feature(s_info))
                     # dynamic information
                     with tf.variable_scope('attention_layer'):
                         context_vector, _ = self.attention_layer(lexicon_features)
-                        context_vector = tf.expand_dims(context_vector, axis=1)
-                        context_vector = tf.tile(context_vector, multiples=[1, self.sentence_length, 1])
-                        embedding.append(context_vector)
+                        embedding.append(self.broadcast_sentence_feature(context_vector))
 
             if config['seg_dim']:
                 with tf.variable_scope('seg_embedding'):
@@ -127,6 +307,107 @@ class Model(object):
                     embedding.append(tf.nn.embedding_lookup(self.seg_lookup, seg_inputs))
         return tf.concat(embedding, axis=-1)
 
+    def embedding_table(self, name, shape, trainable=True):
+        """
+        创建embedding表，返回表和查表函数
+        embedding_precision为float16或int8时（只用于推断）表按低精度存储且不训练，int8每行一个scale，
+        只对查到的行反量化；这些表不从checkpoint恢复，由model_utils.create从float32的值量化后加载
+        :param name:
+        :param shape:
+        :param trainable:
+        :return:
+        """
+        precision = self.config.get('embedding_precision', 'float32')
+        if precision == 'float32':
+            table = tf.get_variable(name=name, shape=shape, initializer=self.initializer, trainable=trainable)
+            return table, lambda ids: tf.nn.embedding_lookup(table, ids)
+
+        checkpoint_name = tf.get_variable_scope().name + '/' + name
+        if precision == 'float16':
+            table = tf.get_variable(name=name + '_float16', shape=shape, dtype=tf.float16,
+                                    initializer=tf.zeros_initializer(), trainable=False)
+            self.quantized_tables.append((checkpoint_name, table, None))
+            return table, lambda ids: tf.cast(tf.nn.embedding_lookup(table, ids), tf.float32)
+        elif precision == 'int8':
+            table = tf.get_variable(name=name + '_int8', shape=shape, dtype=tf.int8,
+                                    initializer=tf.zeros_initializer(), trainable=False)
+            scale = tf.get_variable(name=name + '_scale', shape=[shape[0], 1], dtype=tf.float32,
+                                    initializer=tf.ones_initializer(), trainable=False)
+            self.quantized_tables.append((checkpoint_name, table, scale))
+            return table, lambda ids: tf.cast(tf.nn.embedding_lookup(table, ids), tf.float32) * \
+                tf.nn.embedding_lookup(scale, ids)
+        raise Exception('embedding精度错误')
+
+    def quantized_variables(self):
+        variables = []
+        for _, table, scale in self.quantized_tables:
+            variables.append(table)
+            if scale is not None:
+                variables.append(scale)
+        return variables
+
+    def lexicon_embedding_lookup(self, lexicon_inputs, config):
+        """
+        lexicon_compression为none时是完整的[num_lexicon, lexicon_dim]表；
+        factorized时为[num_lexicon, lexicon_rank]的表乘以[lexicon_rank, lexicon_dim]的投影；
+        hashed时词id先hash到lexicon_buckets个桶，桶表[lexicon_buckets, lexicon_rank]再乘以投影
+        :param lexicon_inputs:
+        :param config:
+        :return: [batch_size, gaz_length, lexicon_dim]
+        """
+        compression = config.get('lexicon_compression', 'none')
+        trainable = not config.get('freeze_lexicon', False)
+        if compression == 'none':
+            self.lexicon_lookup, lookup = self.embedding_table(
+                'lexicon_embedding', [self.num_lexicon, self.lexicon_dim], trainable
+            )
+            return lookup(lexicon_inputs)
+
+        if compression == 'factorized':
+            num_rows = self.num_lexicon
+            ids = lexicon_inputs
+        elif compression == 'hashed':
+            num_rows = config['lexicon_buckets']
+            ids = tf.cast(tf.floormod(
+                tf.cast(lexicon_inputs, tf.int64) * data_utils.LEXICON_HASH_MULTIPLIER, num_rows
+            ), tf.int32)
+        else:
+            raise Exception('lexicon压缩方式错误')
+        self.lexicon_lookup, lookup = self.embedding_table(
+            'lexicon_embedding', [num_rows, config['lexicon_rank']], trainable
+        )
+        self.lexicon_projection = tf.get_variable(
+            name='lexicon_projection',
+            shape=[config['lexicon_rank'], self.lexicon_dim],
+            initializer=self.initializer,
+            trainable=trainable
+        )
+        features = tf.tensordot(lookup(ids), self.lexicon_projection, axes=1)
+        features.set_shape([None, None, self.lexicon_dim])
+        return features
+
+    def lexicon_variables(self):
+        """
+        lexicon embedding相关的变量
+        :return:
+        """
+        if not self.config['lexicon']:
+            return []
+        variables = [self.lexicon_lookup]
+        for _, table, scale in self.quantized_tables:
+            if table is self.lexicon_lookup and scale is not None:
+                variables.append(scale)
+        if self.config.get('lexicon_compression', 'none') != 'none':
+            variables.append(self.lexicon_projection)
+        return variables
+
+    def lexicon_bytes(self):
+        """
+        lexicon embedding参数占用的内存（字节）
+        :return:
+        """
+        return sum(v.shape.num_elements() * v.dtype.base_dtype.size for v in self.lexicon_variables())
+
     def biLSTM_layer(self, lstm_inputs, lstm_dim, lengths, name=None):
         """
         :param lstm_inputs: [batch_size, sentences_length, emd_size]
@@ -145,6 +426,11 @@ class Model(object):
                         initializer=self.initializer,
                         state_is_tuple=True
                     )
+            if self.packed:
+                # 前向在句首、后向在句尾清零状态，与每句单独计算的结果一致
+                lstm_inputs = tf.concat([lstm_inputs, self.reset_flags], axis=-1)
+                lstm_cell['forward'] = ResetStateCell(lstm_cell['forward'], -2)
+                lstm_cell['backward'] = ResetStateCell(lstm_cell['backward'], -1)
             outputs, final_status = tf.nn.bidirectional_dynamic_rnn(
                 lstm_cell['forward'],
                 lstm_cell['backward'],
@@ -190,7 +476,7 @@ class Model(object):
                     initializer=tf.zeros_initializer()
                 )
                 pred = tf.nn.xw_plus_b(hidden, W, b)
-        return tf.reshape(pred, [-1, self.sentence_length, self.num_tags])
+        return tf.reshape(pred, [-1, tf.shape(lstm_outputs)[1], self.num_tags])
 
     def crf_loss_layer(self, project_logits, lengths, name=None):
         """
@@ -201,21 +487,23 @@ class Model(object):
         """
         with tf.variable_scope('crf_loss' if not name else name):
             small_value = -10000.0
+            batch_size = tf.shape(project_logits)[0]
+            sentence_length = tf.shape(project_logits)[1]
             start_logits = tf.concat(
                 [
-                    small_value * tf.ones(shape=[self.batch_size, 1, self.num_tags]),
-                    tf.zeros(shape=[self.batch_size, 1, 1])
+                    small_value * tf.ones(shape=[batch_size, 1, self.num_tags]),
+                    tf.zeros(shape=[batch_size, 1, 1])
                 ], axis=-1
             )
             pad_logits = tf.cast(
-                small_value * tf.ones(shape=[self.batch_size, self.sentence_length, 1]),
+                small_value * tf.ones(shape=[batch_size, sentence_length, 1]),
                 dtype=tf.float32
             )
             logits = tf.concat([project_logits, pad_logits], axis=-1)
             logits = tf.concat([start_logits, logits], axis=1)
             targets = tf.concat(
                 [
-                    tf.cast(self.num_tags * tf.ones([self.batch_size, 1]), tf.int32),
+                    tf.cast(self.num_tags * tf.ones([batch_size, 1]), tf.int32),
                     self.targets
                 ], axis=-1
             )
@@ -254,53 +542,56 @@ class Model(object):
 
     def decode(self, logits, lengths, matrix):
         """
+        在句首加上开始标签后整个batch一起做viterbi解码
         :param logits: [batch_size, sentences_length, num_tags]
         :param lengths:
         :param matrix:
         :return:
         """
-        paths = []
         small = -1000.0
-        start = np.asarray([[small] * self.num_tags + [0]])
-        for score, length in zip(logits, lengths):
-            score = score[:length]
-            pad = small * np.ones([length, 1])
-            logits = np.concatenate([score, pad], axis=1)
-            logits = np.concatenate([start, logits], axis=0)
-            path, _ = viterbi_decode(logits, matrix)
-
-            paths.append(path[1:])
-        return paths
+        batch_size, max_length = logits.shape[:2]
+        scores = np.full([batch_size, max_length + 1, self.num_tags + 1], small)
+        scores[:, 0, -1] = 0
+        scores[:, 1:, :self.num_tags] = logits
+        paths = viterbi_decode_batch(scores, np.asarray(lengths) + 1, matrix)
+        return [path[1:length + 1] for path, length in zip(paths, lengths)]
 
     def create_feed_dict(self, is_train, batch):
         """
         :param is_train:
-        :param batch:
+        :param batch: None时输入来自tf.data的iterator，只设置dropout
         :return:
         """
-        _, words, segs, tags, lexicon = batch
+        if batch is None:
+            return {self.dropout: self.config['dropout_keep'] if is_train else 1.0}
+        # batch中的特征已经是补齐好的int32数组，不再逐步转换
+        _, words, segs, tags, lexicon = batch[:5]
         feed_dict = {
-            self.word_inputs: np.asarray(words),
-            self.seg_inputs: np.asarray(segs),
-            self.lexicon_inputs: np.asarray(lexicon),
+            self.word_inputs: words,
+            self.seg_inputs: segs,
+            self.lexicon_inputs: lexicon,
             self.dropout: 1.0
         }
+        if self.packed:
+            feed_dict[self.pack_index] = batch[5]
         if is_train:
-            feed_dict[self.targets] = np.asarray(tags)
+            feed_dict[self.targets] = tags
             feed_dict[self.dropout] = self.config['dropout_keep']
         return feed_dict
 
-    def run_step(self, sess, is_train, batch):
+    def run_step(self, sess, is_train, batch, feed_dict=None):
         """
         :param sess:
         :param is_train:
         :param batch:
+        :param feed_dict: 已经构造好的feed_dict，None时由batch构造
         :return:
         """
-        feed_dict = self.create_feed_dict(is_train, batch)
+        if feed_dict is None:
+            feed_dict = self.create_feed_dict(is_train, batch)
         if is_train:
-            global_step, loss, _ = sess.run(
-                [self.global_step, self.loss, self.train_op], feed_dict
+            global_step, loss, self.last_step_tokens, _ = sess.run(
+                [self.global_step, self.loss, self.num_tokens, self.train_op], feed_dict
             )
             return global_step, loss
         else:
@@ -309,6 +600,7 @@ class Model(object):
 
     def evaluate(self, sess, data_manager, id_to_tag):
         """
+        eval_threads大于1时，后面batch的sess.run在线程池中进行，与当前batch的解码和格式化重叠
         :param sess:
         :param data_manager:
         :param id_to_tag:
@@ -316,10 +608,9 @@ class Model(object):
         """
         results = []
         trans = self.trans.eval()
-        for batch in data_manager.iter_batch():
+        for batch, (lengths, logits) in self.iter_predictions(sess, data_manager, self.config.get('eval_threads', 1)):
             strings = batch[0]
-            tags = batch[-2]
-            lengths, logits = self.run_step(sess, False, batch)
+            tags = batch[3]
             batch_paths = self.decode(logits, lengths, trans)
             for i in range(len(strings)):
                 result = []
@@ -330,3 +621,26 @@ class Model(object):
                     result.append(" ".join([char, gold, pred]))
                 results.append(result)
         return results
+
+    def iter_predictions(self, sess, data_manager, num_threads=1):
+        """
+        按batch的顺序返回sess.run的结果，最多num_threads个batch同时在运行
+        :param sess:
+        :param data_manager:
+        :param num_threads:
+        :return: (batch, (lengths, logits))
+        """
+        if num_threads <= 1:
+            for batch in data_manager.iter_batch():
+                yield batch, self.run_step(sess, False, batch)
+            return
+        with ThreadPoolExecutor(num_threads) as executor:
+            pending = collections.deque()
+            for batch in data_manager.iter_batch():
+                pending.append((batch, executor.submit(self.run_step, sess, False, batch)))
+                if len(pending) > num_threads:
+                    batch, future = pending.popleft()
+                    yield batch, future.result()
+            while pending:
+                batch, future = pending.popleft()
+                yield batch, future.result()
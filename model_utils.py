@@ -5,9 +5,13 @@ import os
 import logging
 from collections import OrderedDict
 import json
+import time
+import numpy as np
 import tensorflow as tf
 
 from utils.ner_metric import get_ner_measure
+from utils.checkpoint import checkpoint_memmap
+from data_utils import word2vec_cache_path, factorize_embeddings, bucket_embeddings
 from conlleval import return_report
 
 
@@ -52,12 +56,13 @@ def make_path(FLAGS):
         os.mkdir('log')
 
 
-def config_model(FLAGS, word_to_id, tag_to_id):
+def config_model(FLAGS, word_to_id, tag_to_id, num_lexicon):
     """
     配置模型参数
     :param FLAGS:
     :param word_to_id:
     :param tag_to_id:
+    :param num_lexicon: lexicon embedding的行数（包括<UNK>）
     :return:
     """
     config = OrderedDict()
@@ -68,19 +73,28 @@ def config_model(FLAGS, word_to_id, tag_to_id):
     config['lstm_dim'] = FLAGS.lstm_dim
     config['batch_size'] = FLAGS.batch_size
     config['optimizer'] = FLAGS.optimizer
+    config['sparse_update'] = FLAGS.sparse_update
     config['emb_file'] = FLAGS.emb_file
 
     config['clip'] = FLAGS.clip
+    config['clip_mode'] = FLAGS.clip_mode
     config['dropout_keep'] = 1.0 - FLAGS.dropout
     config['lr'] = FLAGS.lr
     config['tag_schema'] = FLAGS.tag_schema
+    config['seg_backend'] = FLAGS.seg_backend
     config['pre_emb'] = FLAGS.pre_emb
+    config['pack_length'] = FLAGS.pack_length   # 大于0时把短句拼接成不超过该长度的行
+    config['eval_threads'] = FLAGS.eval_threads   # 评估时同时运行sess.run的batch数
 
     # lexicon信息
-    config['num_lexicon'] = 1292608
-    # config['num_lexicon'] = 3000
+    config['num_lexicon'] = num_lexicon
     config['lexicon'] = FLAGS.lexicon   # 是否使用lexicon
     config['pre_lexicon'] = FLAGS.pre_lexicon   # 是否使用预训练的lexicon向量
+    config['prune_lexicon'] = FLAGS.prune_lexicon   # 是否只保留语料中匹配到的词，测试时需要与训练一致
+    config['lexicon_compression'] = FLAGS.lexicon_compression   # lexicon向量的压缩方式
+    config['lexicon_rank'] = FLAGS.lexicon_rank
+    config['lexicon_buckets'] = FLAGS.lexicon_buckets
+    config['freeze_lexicon'] = FLAGS.freeze_lexicon   # 是否冻结lexicon向量，冻结后不训练也不写入checkpoint
     config['lexicon_file'] = FLAGS.lexicon_file
     config['map_file'] = FLAGS.map_file
     return config
@@ -118,7 +132,7 @@ def print_config(config, logger):
         logger.info("{}:\t{}".format(k.ljust(15), v))
 
 
-def create(sess, Model, ckpt_path, load_word2vec, config, id_to_word, logger, lexicon_embedding):
+def create(sess, Model, ckpt_path, load_word2vec, config, id_to_word, logger, lexicon_embedding, inputs=None):
     """
     :param sess:
     :param Model:
@@ -128,28 +142,177 @@ def create(sess, Model, ckpt_path, load_word2vec, config, id_to_word, logger, le
     :param id_to_word:
     :param logger:
     :param lexicon_embedding: 词表的向量 [num_lexicon, lexicon_dim]
+    :param inputs: tf.data iterator的输出，None时只用feed_dict
     :return:
     """
-    model = Model(config)
+    model = Model(config, inputs)
 
+    start = time.time()
     ckpt = tf.train.get_checkpoint_state(ckpt_path)
     if ckpt and tf.train.checkpoint_exists(ckpt.model_checkpoint_path):
         logger.info('读取模型参数，从%s' % ckpt.model_checkpoint_path)
         model.saver.restore(sess, ckpt.model_checkpoint_path)
+        if model.quantized_tables:
+            sess.run(tf.variables_initializer(model.quantized_variables()))
+            reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+            for name, table, _ in model.quantized_tables:
+                if reader.has_tensor(name):
+                    # 以内存映射的方式逐块读取float32的表，不把整个表读入内存
+                    weights = checkpoint_memmap(ckpt.model_checkpoint_path, name)
+                    if weights is None:
+                        weights = reader.get_tensor(name)
+                    assign_embedding_table(sess, model, table, weights)
+            logger.info('embedding表以%s加载' % config['embedding_precision'])
+        if config['lexicon'] and config.get('freeze_lexicon', False):
+            sess.run(tf.variables_initializer(model.lexicon_variables()))
+            assign_lexicon_embedding(sess, model, config, lexicon_embedding)
+            logger.info('加载冻结的lexcion向量成功')
     else:
+        if model.quantized_tables:
+            raise Exception('低精度embedding只用于推断，%s中没有可加载的模型' % ckpt_path)
         logger.info('重新训练模型')
         sess.run(tf.global_variables_initializer())
         if config['pre_emb']:
             emb_weights = sess.run(model.word_lookup.read_value())
-            emb_weights = load_word2vec(config['emb_file'], id_to_word, config['word_dim'], emb_weights)
-            sess.run(model.word_lookup.assign(emb_weights))
+            emb_weights = load_word2vec(config['emb_file'], id_to_word, config['word_dim'], emb_weights,
+                                        cache_file=word2vec_cache_path(config['map_file']))
+            assign_embedding(sess, model.word_lookup, emb_weights)
             logger.info('加载词向量成功!')
         if config['pre_lexicon']:
-            sess.run(model.lexicon_lookup.assign(lexicon_embedding))
+            assign_lexicon_embedding(sess, model, config, lexicon_embedding)
             logger.info('加载lexcion向量成功')
+    logger.info('graph size: %.2f MB, init time: %.2fs' % (
+        sess.graph.as_graph_def().ByteSize() / 2 ** 20, time.time() - start))
+    if config['lexicon']:
+        logger.info('lexicon embedding (%s): %.1f MB, full table: %.1f MB' % (
+            config.get('lexicon_compression', 'none'), model.lexicon_bytes() / 2 ** 20,
+            config['num_lexicon'] * model.lexicon_dim * 4 / 2 ** 20))
     return model
 
 
+def create_input_pipeline(manager, packed=False, prefetch=2):
+    """
+    用tf.data包装batch manager，在后台线程中准备后面的batch，与当前的sess.run重叠
+    batch已经由manager按长度分桶、打乱并补齐，这里只按原样输出
+    :param manager: BatchManager或StreamingBatchManager
+    :param packed: batch中是否有pack_index
+    :param prefetch: 预先准备的batch数
+    :return: 每轮开始时需要运行initializer的iterator，Model的inputs
+    """
+    keys = ['word_inputs', 'seg_inputs', 'targets', 'lexicon_inputs']
+    if packed:
+        keys.append('pack_index')
+
+    def generator():
+        for batch in manager.iter_batch(shuffle=True):
+            yield tuple(batch[1:len(keys) + 1])
+
+    dataset = tf.data.Dataset.from_generator(
+        generator,
+        tuple(tf.int32 for _ in keys),
+        tuple(tf.TensorShape([None, None]) for _ in keys)
+    )
+    dataset = dataset.prefetch(prefetch)
+    iterator = dataset.make_initializable_iterator()
+    return iterator, dict(zip(keys, iterator.get_next()))
+
+
+def assign_lexicon_embedding(sess, model, config, lexicon_embedding):
+    """
+    用预训练的lexicon向量初始化lexicon embedding，压缩模式下先做截断SVD分解
+    :param sess:
+    :param model:
+    :param config:
+    :param lexicon_embedding: [num_lexicon, lexicon_dim]
+    :return:
+    """
+    compression = config.get('lexicon_compression', 'none')
+    if compression == 'none':
+        assign_embedding_table(sess, model, model.lexicon_lookup, lexicon_embedding)
+        return
+    if compression == 'hashed':
+        lexicon_embedding = bucket_embeddings(lexicon_embedding, config['lexicon_buckets'])
+    table, projection = factorize_embeddings(lexicon_embedding, config['lexicon_rank'])
+    assign_embedding_table(sess, model, model.lexicon_lookup, table)
+    assign_embedding(sess, model.lexicon_projection, projection)
+
+
+def assign_embedding_table(sess, model, table, weights, chunk_rows=100000):
+    """
+    给embedding表赋值，低精度存储的表逐块转换为float16或量化为int8，不生成整个表的float32或低精度副本
+    :param sess:
+    :param model:
+    :param table:
+    :param weights: float32的[num_rows, dim]，可以是np.memmap，每次只读取chunk_rows行
+    :param chunk_rows:
+    :return:
+    """
+    for _, quantized_table, scale in model.quantized_tables:
+        if quantized_table is table:
+            assign_table = embedding_assigner(sess, table)
+            assign_scale = embedding_assigner(sess, scale) if scale is not None else None
+            for start in range(0, len(weights), chunk_rows):
+                chunk = weights[start:start + chunk_rows]
+                if scale is None:
+                    assign_table(start, np.asarray(chunk, dtype=np.float16))
+                else:
+                    quantized, scales = quantize_embedding(chunk)
+                    assign_table(start, quantized)
+                    assign_scale(start, scales)
+            return
+    assign_embedding(sess, table, weights, chunk_rows)
+
+
+def quantize_embedding(weights, chunk_rows=100000):
+    """
+    按行对称量化为int8，scale为每行绝对值的最大值除以127
+    :param weights: [num_rows, dim]
+    :param chunk_rows:
+    :return: int8的[num_rows, dim], float32的[num_rows, 1]
+    """
+    quantized = np.empty(weights.shape, dtype=np.int8)
+    scales = np.empty([len(weights), 1], dtype=np.float32)
+    for start in range(0, len(weights), chunk_rows):
+        chunk = np.asarray(weights[start:start + chunk_rows], dtype=np.float32)
+        scale = np.abs(chunk).max(axis=1, keepdims=True) / 127.0
+        scale[scale == 0] = 1.0
+        quantized[start:start + chunk_rows] = np.clip(np.round(chunk / scale), -127, 127)
+        scales[start:start + chunk_rows] = scale
+    return quantized, scales
+
+
+def assign_embedding(sess, variable, weights, chunk_rows=100000):
+    """
+    通过placeholder分块给embedding变量赋值，矩阵不会作为常量写入GraphDef
+    :param sess:
+    :param variable: [num_rows, dim]的变量
+    :param weights: [num_rows, dim]的矩阵，可以是np.memmap，每次只读取chunk_rows行
+    :param chunk_rows:
+    :return:
+    """
+    assign = embedding_assigner(sess, variable)
+    for start in range(0, len(weights), chunk_rows):
+        assign(start, weights[start:start + chunk_rows])
+
+
+def embedding_assigner(sess, variable):
+    """
+    :param sess:
+    :param variable: [num_rows, dim]的变量
+    :return: 函数assign(start, rows)，把rows写入变量从start开始的行
+    """
+    with tf.name_scope('assign_embedding'):
+        rows = tf.placeholder(variable.dtype.base_dtype, shape=[None, variable.shape[1]])
+        offset = tf.placeholder(tf.int32, shape=[])
+        indices = tf.range(offset, offset + tf.shape(rows)[0])
+        # 只运行op，不取回整个变量
+        assign_op = tf.scatter_update(variable, indices, rows).op
+
+    def assign(start, weights):
+        sess.run(assign_op, {rows: weights, offset: start})
+    return assign
+
+
 def test_ner(results, path):
     """
     :param results:
@@ -203,5 +366,8 @@ def save_model(sess, model, path, logger):
     :return:
     """
     checkpoint_path = os.path.join(path, 'ner.ckpt')
-    model.saver.save(sess, checkpoint_path)
-    logger.info('模型已保存')
+    saved_path = model.saver.save(sess, checkpoint_path)
+    # 冻结的lexicon不写入checkpoint，记录大小便于对比
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path)
+               if f.startswith(os.path.basename(saved_path) + '.'))
+    logger.info('模型已保存，checkpoint大小: %.1f MB' % (size / 2 ** 20))
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+# __author__ = 'zd'
+
+import os
+import struct
+
+import numpy as np
+from tensorflow.core.protobuf import tensor_bundle_pb2
+
+# checkpoint的index文件是不压缩的leveldb table，结尾是48字节的footer，最后8字节为magic number
+TABLE_MAGIC = 0xdb4775248b80fb57
+FOOTER_SIZE = 48
+DTYPES = {1: np.float32, 2: np.float64, 3: np.int32, 6: np.int8, 9: np.int64, 19: np.float16}
+
+
+def _varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _block_entries(data, offset, size):
+    """
+    :param data: index文件的内容
+    :param offset: block的起始位置
+    :param size: block的大小，不含5字节的类型和crc
+    :return: [(key, value)]
+    """
+    if data[offset + size] != 0:
+        raise Exception('checkpoint的index是压缩过的，无法直接读取')
+    num_restarts = struct.unpack('<I', data[offset + size - 4:offset + size])[0]
+    end = offset + size - 4 * (num_restarts + 1)
+    entries = []
+    key = b''
+    pos = offset
+    while pos < end:
+        shared, pos = _varint(data, pos)
+        non_shared, pos = _varint(data, pos)
+        value_length, pos = _varint(data, pos)
+        key = key[:shared] + data[pos:pos + non_shared]
+        pos += non_shared
+        entries.append((key, data[pos:pos + value_length]))
+        pos += value_length
+    return entries
+
+
+def read_bundle_index(checkpoint_path):
+    """
+    读取V2格式checkpoint的index
+    :param checkpoint_path: checkpoint的前缀，如ckpt/ner.ckpt-100
+    :return: BundleHeaderProto, {张量名: BundleEntryProto}
+    """
+    with open(checkpoint_path + '.index', 'rb') as f:
+        data = f.read()
+    if struct.unpack('<Q', data[-8:])[0] != TABLE_MAGIC:
+        raise Exception('%s.index不是V2格式的checkpoint' % checkpoint_path)
+    # footer依次为metaindex和index两个block的(offset, size)
+    pos = len(data) - FOOTER_SIZE
+    _, pos = _varint(data, pos)
+    _, pos = _varint(data, pos)
+    index_offset, pos = _varint(data, pos)
+    index_size, pos = _varint(data, pos)
+    header = tensor_bundle_pb2.BundleHeaderProto()
+    entries = {}
+    for _, handle in _block_entries(data, index_offset, index_size):
+        block_offset, pos = _varint(handle, 0)
+        block_size, _ = _varint(handle, pos)
+        for key, value in _block_entries(data, block_offset, block_size):
+            if key == b'':
+                header.ParseFromString(value)
+            else:
+                entry = tensor_bundle_pb2.BundleEntryProto()
+                entry.ParseFromString(value)
+                entries[key.decode('UTF-8')] = entry
+    return header, entries
+
+
+def checkpoint_memmap(checkpoint_path, name):
+    """
+    以内存映射的方式打开checkpoint中完整保存的张量，按行切片时才从磁盘读取这些行
+    tf的restore对完整保存的张量只能整个读入，即使只请求其中一个切片
+    :param checkpoint_path: checkpoint的前缀
+    :param name: 张量名
+    :return: 只读的np.memmap，张量不存在、为空、分片保存或类型不支持时为None
+    """
+    header, entries = read_bundle_index(checkpoint_path)
+    entry = entries.get(name)
+    if entry is None or entry.slices or entry.dtype not in DTYPES or entry.size == 0:
+        return None
+    if header.endianness != tensor_bundle_pb2.BundleHeaderProto.LITTLE:
+        return None
+    dtype = np.dtype(DTYPES[entry.dtype]).newbyteorder('<')
+    shape = tuple(dim.size for dim in entry.shape.dim)
+    if entry.size != dtype.itemsize * int(np.prod(shape)):
+        raise Exception('%s中%s的大小与形状不一致' % (checkpoint_path, name))
+    data_path = '%s.data-%05d-of-%05d' % (checkpoint_path, entry.shard_id, header.num_shards)
+    if not os.path.isfile(data_path):
+        raise Exception('找不到checkpoint的数据文件%s' % data_path)
+    return np.memmap(data_path, dtype=dtype, mode='r', offset=entry.offset, shape=shape)
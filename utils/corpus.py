@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+# __author__ = 'zd'
+
+import os
+import numpy as np
+
+
+class Corpus(object):
+    """
+    按列存储的预处理结果：每种特征一个拼接起来的一维数组，第i句为offsets[i]:offsets[i + 1]
+    与prepare_dataset原来的[word_list, word_id_list, seg_list, tag_id_list, lexicon_list]一一对应
+    """
+    FEATURES = ('word_ids', 'segs', 'tag_ids', 'lexicon_ids')
+
+    def __init__(self, offsets, words, word_ids, segs, tag_ids, lexicon_ids):
+        self.offsets = offsets
+        self.words = words
+        self.word_ids = word_ids
+        self.segs = segs
+        self.tag_ids = tag_ids
+        self.lexicon_ids = lexicon_ids
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: [[word_list, word_id_list, seg_list, tag_id_list, lexicon_list], ...]
+        :return:
+        """
+        lengths = [len(line[0]) for line in rows]
+        for line in rows:
+            assert all(len(feature) == len(line[0]) for feature in line), 'features must have the sentence length'
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        words = np.array([w for line in rows for w in line[0]], dtype=str)
+        features = [np.fromiter((i for line in rows for i in line[k]), dtype=np.int32, count=offsets[-1])
+                    for k in range(1, 5)]
+        return cls(offsets, words, *features)
+
+    @classmethod
+    def concatenate(cls, corpora):
+        """
+        :param corpora:
+        :return: 按顺序拼接的Corpus
+        """
+        corpora = list(corpora)
+        if not corpora:
+            return cls.from_rows([])
+        offsets = [np.zeros(1, dtype=np.int64)]
+        total = 0
+        for corpus in corpora:
+            offsets.append(corpus.offsets[1:] + total)
+            total += corpus.offsets[-1]
+        columns = [np.concatenate([getattr(corpus, name) for corpus in corpora])
+                   for name in ('words',) + cls.FEATURES]
+        return cls(np.concatenate(offsets), *columns)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        """
+        :param i:
+        :return: 第i句的[words, word_ids, segs, tag_ids, lexicon_ids]，均为数组的视图
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return [self.words[start:end]] + [getattr(self, name)[start:end] for name in self.FEATURES]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def num_tokens(self):
+        return int(self.offsets[-1])
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ('offsets', 'words') + self.FEATURES)
+
+    def pad(self, indices, max_length=None):
+        """
+        取出indices对应的句子并补齐到同一长度
+        :param indices: 句子下标
+        :param max_length: 补齐的长度，None为这些句子的最大长度
+        :return: [words, word_ids, segs, tag_ids, lexicon_ids]，[batch_size, max_length]的数组，words用''补齐，其余用0补齐
+        """
+        indices = np.asarray(indices)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        if max_length is None:
+            max_length = int(lengths.max()) if len(indices) else 0
+        positions = np.arange(max_length)
+        mask = positions < lengths[:, None]
+        if self.num_tokens() == 0:
+            return [np.full(mask.shape, '')] + [np.zeros(mask.shape, dtype=np.int32) for _ in self.FEATURES]
+        # 补齐的位置指向句首，再由mask置为0
+        index = np.minimum(np.where(mask, starts[:, None] + positions, starts[:, None]), self.num_tokens() - 1)
+        batch = [np.where(mask, self.words[index], '')]
+        for name in self.FEATURES:
+            batch.append(np.where(mask, getattr(self, name)[index], 0).astype(np.int32))
+        return batch
+
+    def pack(self, rows):
+        """
+        把几个句子首尾相接放进同一行，word_ids和segs按行打包，其余特征仍按句子补齐
+        :param rows: 每行的句子下标列表
+        :return: [words, word_ids, segs, tag_ids, lexicon_ids, pack_index]，word_ids和segs为[num_rows, row_length]，
+                 其余为[num_sentences, max_length]，pack_index为句子每个位置在展平的打包数组中的下标，补齐位置为-1
+        """
+        row_sizes = np.array([len(row) for row in rows])
+        indices = np.concatenate([np.asarray(row, dtype=np.int64) for row in rows])
+        batch = self.pad(indices)
+        lengths = self.offsets[indices + 1] - self.offsets[indices]
+        row_of_sentence = np.repeat(np.arange(len(rows)), row_sizes)
+        # 句子在所在行中的起始位置
+        starts = np.cumsum(lengths) - lengths
+        first_sentence = np.cumsum(row_sizes) - row_sizes
+        starts -= starts[first_sentence][row_of_sentence]
+        row_length = int((starts + lengths).max())
+
+        mask = np.arange(batch[1].shape[1]) < lengths[:, None]
+        pack_index = np.where(
+            mask, (row_of_sentence * row_length + starts)[:, None] + np.arange(batch[1].shape[1]), -1
+        ).astype(np.int32)
+        packed = []
+        for column in batch[1:3]:
+            flat = np.zeros(len(rows) * row_length, dtype=np.int32)
+            flat[pack_index[mask]] = column[mask]
+            packed.append(flat.reshape(len(rows), row_length))
+        return [batch[0]] + packed + batch[3:] + [pack_index]
+
+    def save(self, path):
+        """
+        保存为npz，先写临时文件再改名
+        :param path:
+        :return:
+        """
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **{name: getattr(self, name) for name in ('offsets', 'words') + self.FEATURES})
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(*[f[name] for name in ('offsets', 'words') + cls.FEATURES])
@@ -2,17 +2,35 @@
 # -*- coding: UTF-8 -*-
 # __author__ = 'zd'
 
-from utils.trie import Trie
+import json
+import os
+
+import numpy as np
+
+from utils.trie import Trie, CompactTrie
 
 
 class Lexicon(object):
-    def __init__(self, lower=True):
+    def __init__(self, lower=True, compact=False):
+        """
+        :param lower: 是否转为小写
+        :param compact: 是否使用紧凑的数组trie，insert完成后需调用build，之后词id保存在trie节点中，
+                        不再保留ent2id和ent2type两个字符串字典
+        """
         self.lower = lower
+        self.compact = compact
 
         self.trie = Trie()
         self.ent2type = {}            # word list to type
         self.ent2id = {'<UNK>': 0}    # word list to id
         self.space = ''
+        # 词表内容的标识，由加载词表的函数设置，用于缓存的key
+        self.version = None
+
+        # compact模式下build之后使用
+        self.sources = []             # type id to type
+        self.type_ids = None          # lexicon id to type id
+        self.num_entries = 0
 
     def enumerate_match_list(self, word_list):
         if self.lower:
@@ -20,20 +38,57 @@ class Lexicon(object):
         match_list = self.trie.enumerate_match(word_list, self.space)
         return match_list
 
+    def match_sentence(self, sentence, min_length=2):
+        """
+        一次性匹配整个句子中的所有词，每个起始位置只沿trie走一遍
+        :param sentence: 句子，字符串或字符列表
+        :param min_length: 最短匹配长度，与enumerate_match_list一致默认为2
+        :return: [(start, end, lexicon_id)]，按start升序，同一start内按长度降序
+        """
+        if self.lower:
+            sentence = [word.lower() for word in sentence]
+        matches = []
+        for start in range(len(sentence)):
+            for end, lexicon_id in reversed(self.trie.prefix_match(sentence, start)):
+                if end - start >= min_length:
+                    matches.append((start, end, lexicon_id))
+        return matches
+
     def insert(self, word_list, source):
         if self.lower:
             word_list = [word.lower() for word in word_list]
-        self.trie.insert(word_list)
         string = self.space.join(word_list)
         if string not in self.ent2type:
             self.ent2type[string] = source
         if string not in self.ent2id:
             self.ent2id[string] = len(self.ent2id)
+        if not self.compact:
+            self.trie.insert(word_list, self.ent2id[string])
+        return self.ent2id[string]
+
+    def build(self):
+        """
+        compact模式下把insert的词编译成CompactTrie，并释放字符串字典
+        :return:
+        """
+        if not self.compact:
+            return
+        self.sources = sorted(set(self.ent2type.values()))
+        source_to_id = {source: i for i, source in enumerate(self.sources)}
+        self.type_ids = np.zeros(len(self.ent2id), dtype=np.uint8)
+        for string, source in self.ent2type.items():
+            self.type_ids[self.ent2id[string]] = source_to_id[source]
+        self.num_entries = len(self.ent2type)
+        self.trie = CompactTrie.build((string, i) for string, i in self.ent2id.items() if string != '<UNK>')
+        self.ent2type = None
+        self.ent2id = None
 
     def search_id(self, word_list):
         if self.lower:
             word_list = [word.lower() for word in word_list]
         string = self.space.join(word_list)
+        if self.ent2id is None:
+            return self.trie.get(string, 0)
         if string in self.ent2id:
             return self.ent2id[string]
         return self.ent2id['<UNK>']
@@ -42,16 +97,75 @@ class Lexicon(object):
         if self.lower:
             word_list = [word.lower() for word in word_list]
         string = self.space.join(word_list)
-        if string in self.ent2type:
+        if self.ent2type is None:
+            lexicon_id = self.trie.get(string)
+            if lexicon_id is not None:
+                return self.sources[self.type_ids[lexicon_id]]
+        elif string in self.ent2type:
             return self.ent2type[string]
         print('Error in finding entity type at lexicon.py, exit programming')
         exit(0)
 
     def size(self):
+        if self.ent2type is None:
+            return self.num_entries
         return len(self.ent2type)
 
+    def memory_usage(self):
+        """
+        trie和类型表占用的内存（字节），非compact模式为估算值
+        :return:
+        """
+        if self.type_ids is not None:
+            return self.trie.nbytes() + self.type_ids.nbytes
+        return self.trie.nbytes()
+
+    def save(self, path):
+        """
+        保存build之后的compact词表到文件夹path
+        :param path:
+        :return:
+        """
+        assert self.type_ids is not None, 'only a built compact lexicon can be saved'
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'trie_labels.npy'), self.trie.labels)
+        np.save(os.path.join(path, 'trie_first_child.npy'), self.trie.first_child)
+        np.save(os.path.join(path, 'trie_values.npy'), self.trie.values)
+        np.save(os.path.join(path, 'type_ids.npy'), self.type_ids)
+        with open(os.path.join(path, 'lexicon.json'), 'w', encoding='UTF-8') as f:
+            json.dump({'lower': self.lower, 'space': self.space, 'sources': self.sources,
+                       'num_entries': self.num_entries}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        从文件夹path加载compact词表，默认以内存映射方式打开
+        :param path:
+        :param mmap_mode:
+        :return:
+        """
+        with open(os.path.join(path, 'lexicon.json'), encoding='UTF-8') as f:
+            info = json.load(f)
+        lexicon = cls(lower=info['lower'], compact=True)
+        lexicon.space = info['space']
+        lexicon.sources = info['sources']
+        lexicon.num_entries = info['num_entries']
+        lexicon.trie = CompactTrie(
+            np.load(os.path.join(path, 'trie_labels.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'trie_first_child.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(path, 'trie_values.npy'), mmap_mode=mmap_mode)
+        )
+        lexicon.type_ids = np.load(os.path.join(path, 'type_ids.npy'), mmap_mode=mmap_mode)
+        lexicon.ent2type = None
+        lexicon.ent2id = None
+        return lexicon
+
     def clean(self):
         self.trie = Trie()
         self.ent2type = {}
         self.ent2id = {}
         self.space = ''
+        self.sources = []
+        self.type_ids = None
+        self.num_entries = 0
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+# __author__ = 'zd'
+
+import collections
+import hashlib
+import os
+import sqlite3
+import time
+
+
+class SegCache(object):
+    """
+    分词特征的缓存：进程内的LRU，加上以sqlite持久化的磁盘缓存
+    key为分词器版本和句子的sha1，分词器或词典变化后旧的结果不会再被命中
+    """
+    def __init__(self, path, version, lru_size=100000, flush_size=10000):
+        self.path = path
+        self.version = version
+        self.lru_size = lru_size
+        self.flush_size = flush_size
+
+        self.lru = collections.OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+        self.miss_time = 0.0
+
+        self._connection = None
+        self._pid = None
+        self._unsaved = [0, 0.0]
+
+    def _connect(self):
+        # sqlite连接不能跨进程使用，fork之后的子进程重新连接；fork之前需要先flush
+        # 流式训练时由tf.data的线程调用，同一时间只有一个线程使用，所以允许跨线程
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS seg (key TEXT PRIMARY KEY, value BLOB)')
+            # 累计的未命中次数和分词耗时，用于估计命中节省的时间
+            self._connection.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def key(self, sentence):
+        return hashlib.sha1((self.version + '\n' + sentence).encode('UTF-8')).hexdigest()
+
+    def get(self, sentence, segment):
+        """
+        :param sentence:
+        :param segment: 未命中时计算分词特征的函数 segment(sentence) -> [0-3]
+        :return:
+        """
+        key = self.key(sentence)
+        value = self.lru.get(key)
+        if value is None:
+            row = self._connect().execute('SELECT value FROM seg WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                value = bytes(row[0])
+        if value is not None:
+            self.hits += 1
+        else:
+            start = time.time()
+            value = bytes(segment(sentence))
+            self.miss_time += time.time() - start
+            self.misses += 1
+            self._unsaved[0] += 1
+            self._unsaved[1] += time.time() - start
+            self.pending.append((key, value))
+            if len(self.pending) >= self.flush_size:
+                self.flush()
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+        return list(value)
+
+    def flush(self):
+        if self.pending:
+            connection = self._connect()
+            connection.executemany('INSERT OR IGNORE INTO seg (key, value) VALUES (?, ?)', self.pending)
+            for name, value in zip(['misses', 'miss_time'], self._unsaved):
+                connection.execute('INSERT OR IGNORE INTO stats (name, value) VALUES (?, 0)', (name,))
+                connection.execute('UPDATE stats SET value = value + ? WHERE name = ?', (value, name))
+            connection.commit()
+            self.pending = []
+            self._unsaved = [0, 0.0]
+
+    def average_miss_time(self):
+        """
+        所有运行中平均每句的分词耗时
+        :return:
+        """
+        stats = dict(self._connect().execute('SELECT name, value FROM stats').fetchall())
+        misses = stats.get('misses', 0) + self._unsaved[0]
+        miss_time = stats.get('miss_time', 0.0) + self._unsaved[1]
+        return miss_time / misses if misses else 0.0
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        saved = self.hits * self.average_miss_time()
+        return 'seg cache: %i/%i hits (%.1f%%), segmentation time %.2fs, about %.2fs saved' % (
+            self.hits, total, 100 * hit_rate, self.miss_time, saved)
+
+    def close(self):
+        self.flush()
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
@@ -2,24 +2,33 @@
 # -*- coding: UTF-8 -*-
 # __author__ = 'zd'
 
+import bisect
 import collections
+import sys
+
+import numpy as np
 
 
 class TrieNode(object):
+    __slots__ = ('children', 'is_word', 'value')
+
     def __init__(self):
         self.children = collections.defaultdict(TrieNode)
         self.is_word = False
+        self.value = None
 
 
 class Trie(object):
     def __init__(self):
         self.root = TrieNode()
 
-    def insert(self, word):
+    def insert(self, word, value=None):
         current = self.root
         for letter in word:
             current = current.children[letter]
         current.is_word = True
+        if value is not None:
+            current.value = value
 
     def search(self, word):
         current = self.root
@@ -37,10 +46,148 @@ class Trie(object):
                 return False
         return True
 
+    def prefix_match(self, word, start=0):
+        """
+        从start开始沿trie只走一遍，遇到不存在的子节点就停止
+        :param word: 字符序列
+        :param start: 起始位置
+        :return: [(end, value)]，end从小到大，word[start:end]为词表中的词
+        """
+        matched = []
+        current = self.root
+        for end in range(start, len(word)):
+            current = current.children.get(word[end])
+            if current is None:
+                break
+            if current.is_word:
+                matched.append((end + 1, current.value))
+        return matched
+
     def enumerate_match(self, word, space='_', backward=False):
         matched = []
-        while len(word) > 1:
-            if self.search(word):
-                matched.append(space.join(word[:]))
-            del word[-1]
+        for end, _ in reversed(self.prefix_match(word)):
+            if end > 1:
+                matched.append(space.join(word[:end]))
         return matched
+
+    def nbytes(self):
+        """
+        估算所有节点占用的内存（字节）
+        :return:
+        """
+        total = 0
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            total += sys.getsizeof(node) + sys.getsizeof(node.children)
+            stack.extend(node.children.values())
+        return total
+
+
+class CompactTrie(object):
+    """
+    基于数组的紧凑trie，节点按层次遍历编号，同一父节点的子节点连续存放并按码位排序
+    labels[i]: 节点i入边上的字符码位
+    first_child[i]: 节点i的子节点为first_child[i]到first_child[i + 1]
+    values[i]: 节点i为词尾时的值（lexicon id），否则为-1
+    """
+    def __init__(self, labels, first_child, values):
+        self.labels = labels
+        self.first_child = first_child
+        self.values = values
+        # memoryview取值返回python int，二分查找比直接索引numpy数组快
+        self._labels = memoryview(labels)
+        self._first_child = memoryview(first_child)
+        self._values = memoryview(values)
+
+    @classmethod
+    def build(cls, items):
+        """
+        :param items: [(key, value)]，key为字符串，value为非负整数，key不重复
+        :return:
+        """
+        items = sorted(items)
+        keys = [key for key, _ in items]
+        labels = [0]
+        values = [-1]
+        first_child = []
+        queue = collections.deque([(0, len(keys), 0)])
+        while queue:
+            lo, hi, depth = queue.popleft()
+            node = len(first_child)
+            if lo < hi and len(keys[lo]) == depth:
+                values[node] = items[lo][1]
+                lo += 1
+            first_child.append(len(labels))
+            while lo < hi:
+                letter = keys[lo][depth]
+                mid = lo + 1
+                while mid < hi and keys[mid][depth] == letter:
+                    mid += 1
+                labels.append(ord(letter))
+                values.append(-1)
+                queue.append((lo, mid, depth + 1))
+                lo = mid
+        first_child.append(len(labels))
+        return cls(np.asarray(labels, dtype=np.int32),
+                   np.asarray(first_child, dtype=np.int32),
+                   np.asarray(values, dtype=np.int32))
+
+    def _child(self, node, letter):
+        lo = self._first_child[node]
+        hi = self._first_child[node + 1]
+        code = ord(letter)
+        i = bisect.bisect_left(self._labels, code, lo, hi)
+        if i < hi and self._labels[i] == code:
+            return i
+        return -1
+
+    def _walk(self, node, unit):
+        for letter in unit:
+            node = self._child(node, letter)
+            if node < 0:
+                break
+        return node
+
+    def get(self, word, default=None):
+        node = self._walk(0, ''.join(word))
+        if node < 0 or self._values[node] < 0:
+            return default
+        return self._values[node]
+
+    def search(self, word):
+        return self.get(word) is not None
+
+    def starts_with(self, prefix):
+        return self._walk(0, ''.join(prefix)) >= 0
+
+    def prefix_match(self, word, start=0):
+        labels = self._labels
+        first_child = self._first_child
+        values = self._values
+        matched = []
+        node = 0
+        for end in range(start, len(word)):
+            for letter in word[end]:
+                lo = first_child[node]
+                hi = first_child[node + 1]
+                code = ord(letter)
+                node = bisect.bisect_left(labels, code, lo, hi)
+                if node == hi or labels[node] != code:
+                    return matched
+            if values[node] >= 0:
+                matched.append((end + 1, values[node]))
+        return matched
+
+    def enumerate_match(self, word, space='_', backward=False):
+        matched = []
+        for end, _ in reversed(self.prefix_match(word)):
+            if end > 1:
+                matched.append(space.join(word[:end]))
+        return matched
+
+    def size(self):
+        return int(np.count_nonzero(np.asarray(self.values) >= 0))
+
+    def nbytes(self):
+        return self.labels.nbytes + self.first_child.nbytes + self.values.nbytes
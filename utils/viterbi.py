@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+# -*- coding: UTF-8 -*-
+# __author__ = 'zd'
+
+import time
+import numpy as np
+
+
+def viterbi_decode(score, transition_params):
+    """
+    单个句子的viterbi解码，与tf.contrib.crf.viterbi_decode相同
+    :param score: [sentence_length, num_tags]
+    :param transition_params: [num_tags, num_tags]
+    :return: 最优路径，路径得分
+    """
+    trellis = np.zeros_like(score)
+    backpointers = np.zeros_like(score, dtype=np.int32)
+    trellis[0] = score[0]
+    for t in range(1, score.shape[0]):
+        v = np.expand_dims(trellis[t - 1], 1) + transition_params
+        trellis[t] = score[t] + np.max(v, 0)
+        backpointers[t] = np.argmax(v, 0)
+    viterbi = [np.argmax(trellis[-1])]
+    for bp in reversed(backpointers[1:]):
+        viterbi.append(bp[viterbi[-1]])
+    viterbi.reverse()
+    return viterbi, np.max(trellis[-1])
+
+
+def viterbi_decode_batch(scores, lengths, transition_params):
+    """
+    整个batch一起做viterbi解码，每一步对所有句子同时计算，超过句子长度的位置不更新
+    每个句子的结果与viterbi_decode(scores[i][:lengths[i]], transition_params)完全相同
+    :param scores: [batch_size, max_length, num_tags]
+    :param lengths: [batch_size]，每个句子至少为1
+    :param transition_params: [num_tags, num_tags]
+    :return: [batch_size, max_length]的最优路径，超过句子长度的位置为0
+    """
+    scores = np.asarray(scores)
+    lengths = np.asarray(lengths)
+    batch_size, max_length, num_tags = scores.shape
+    # 与逐句解码一样，trellis按scores的类型保存
+    trellis = scores[:, 0].copy()
+    backpointers = np.zeros([batch_size, max_length, num_tags], dtype=np.int32)
+    for t in range(1, max_length):
+        v = trellis[:, :, None] + transition_params
+        active = (t < lengths)[:, None]
+        trellis = np.where(active, (scores[:, t] + np.max(v, 1)).astype(scores.dtype), trellis)
+        backpointers[:, t] = np.argmax(v, 1)
+
+    paths = np.zeros([batch_size, max_length], dtype=np.int32)
+    rows = np.arange(batch_size)
+    last = np.argmax(trellis, 1)
+    paths[rows, lengths - 1] = last
+    tags = last
+    for t in range(max_length - 1, 0, -1):
+        # 句子最后一个位置之前才沿backpointers回溯
+        previous = backpointers[rows, t, tags]
+        active = t < lengths
+        tags = np.where(active, previous, tags)
+        paths[active, t - 1] = tags[active]
+    return paths
+
+
+if __name__ == '__main__':
+    # 与逐句解码的结果和速度对比
+    rng = np.random.RandomState(0)
+    num_tags = 13
+    transitions = rng.randn(num_tags + 1, num_tags + 1).astype(np.float32)
+    for batch_size, max_length in [(128, 20), (128, 50), (128, 100)]:
+        lengths = rng.randint(1, max_length + 1, size=batch_size)
+        logits = rng.randn(batch_size, max_length + 1, num_tags + 1)
+        start = time.time()
+        expected = [viterbi_decode(score[:length + 1], transitions)[0] for score, length in zip(logits, lengths)]
+        loop_time = time.time() - start
+        start = time.time()
+        paths = viterbi_decode_batch(logits, lengths + 1, transitions)
+        batch_time = time.time() - start
+        same = all(list(path[:length + 1]) == list(e) for path, length, e in zip(paths, lengths, expected))
+        print('batch %i, max length %i: loop %.1fms, batch %.1fms, identical: %s' % (
+            batch_size, max_length, 1000 * loop_time, 1000 * batch_time, same))